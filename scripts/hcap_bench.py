@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Benchmark the host capture code using pre-generated sample data
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, io, json, tempfile, contextlib
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import hcap, fpgaregs, fpgasim, capfile
+
+STAGES = ["framing", "decode", "write", "e2e"]
+
+# Default link speed that the host must keep up with (USB hi-speed module)
+LINK_RATE = 40000000.
+
+
+######################################################################
+# Test configurations
+######################################################################
+
+# Return a list of (name, hcap_args) for each configuration to test
+def build_configs(bits_list, channels_list, rates):
+    configs = []
+    for bits in bits_list:
+        for num_channels in channels_list:
+            chans = ",".join(["ch%d" % (ch,) for ch in range(num_channels)])
+            for rate in rates:
+                if bits == 12 and rate == "125Mhz":
+                    # 12 bit mode requires summing
+                    continue
+                name = "bits=%d ch=%d rate=%s" % (bits, num_channels, rate)
+                configs.append((name, ["-b", str(bits), "-c", chans,
+                                       "-q", rate]))
+            if num_channels <= 2 and bits != 12:
+                name = "bits=%d ch=%d rate=250Mhz" % (bits, num_channels)
+                configs.append((name, ["-b", str(bits), "-c", chans,
+                                       "-q", "250Mhz"]))
+    return configs
+
+# Setup an HProcessor (without a device) for a set of hcap arguments
+def setup_processor(args, fmt, filename):
+    hp = hcap.HProcessor()
+    opts = optparse.OptionParser()
+    hp.setup_cmdline_options(opts)
+    options, args = opts.parse_args(args + ["--stream", "--format", fmt])
+    hp.note_cmdline_options(options, args)
+    hp.note_filename(filename)
+    sqhelper = hp.sqhelper
+    sqhelper.af_helpers = hp.af_helpers
+    sqhelper._calc_meas_mask()
+    return hp
+
+# Generate a stream of SAMPLE messages for a configuration
+def build_stream(hp, data_size):
+    sqhelper = hp.sqhelper
+    mps, shift, code = hcap.DEPOSIT_TYPES[sqhelper.meas_bits]
+    config = (1, int(sqhelper.do_meas_sum), code, sqhelper.channel_div - 1,
+              sqhelper.meas_mask, sqhelper.meas_base)
+    channels = [(ch, config) for ch, ah in enumerate(hp.af_helpers)
+                if ah.check_is_capturing()]
+    table = fpgasim.SampleTable(channels, fpgasim.DEFAULT_SIGNALS,
+                                sqhelper.fpga_freq, 0.)
+    # Build the stream from the repeating table of queue entries
+    entries = data_size // hcap.BYTES_PER_SAMPLE
+    entries -= entries % len(channels)
+    msgs = []
+    seq = 0
+    for pos in range(0, entries, fpgasim.MAX_MSG_ENTRIES):
+        count = min(fpgasim.MAX_MSG_ENTRIES, entries - pos)
+        seq = (seq + 1) & 0x3f
+        msgs.append(fpgasim.encode_message(1, seq, table.get_entries(pos,
+                                                                     count)))
+    stream = b"".join(msgs)
+    data = b"".join([m[3:-3] for m in msgs])
+    return stream, data
+
+
+######################################################################
+# Stage benchmarks
+######################################################################
+
+# Serial device that returns a pre-generated stream
+class StreamReader:
+    def __init__(self, stream, serialhdl):
+        self.stream = memoryview(stream)
+        self.pos = 0
+        self.serialhdl = serialhdl
+    def readinto(self, view):
+        count = min(len(view), len(self.stream) - self.pos)
+        if not count:
+            # Stream complete - stop read_data()
+            self.serialhdl.read_finish = 0.
+            return 0
+        view[:count] = self.stream[self.pos:self.pos + count]
+        self.pos += count
+        return count
+    def read(self, size):
+        d = bytearray(size)
+        count = self.readinto(memoryview(d))
+        return bytes(d[:count])
+    def write(self, data):
+        pass
+
+def run_stream(stream, callback):
+    sh = hcap.SerialHandler(fpgaregs.FPGA_MODULES)
+    ser = StreamReader(stream, sh)
+    sh.ser = ser
+    sh.ser_readinto = ser.readinto
+    sh.register_stream(0x61, callback)
+    sh.set_bulk_mode(True)
+    sh.read_data(time.time() + 3600.)
+
+def bench_framing(hp, stream, data):
+    counts = [0]
+    def note_data(msgdata):
+        counts[0] += len(msgdata)
+    start_time = time.time()
+    run_stream(stream, note_data)
+    elapsed = time.time() - start_time
+    if counts[0] != len(data):
+        raise hcap.error("Framing lost data (%d vs %d)"
+                         % (counts[0], len(data)))
+    return elapsed
+
+def bench_decode(hp, stream, data):
+    decoder = hp.sqhelper._get_capture_info().get_decoder()
+    block_size = capfile.DECODE_BLOCK_GROUPS * decoder.get_group_size()
+    start_time = time.time()
+    with memoryview(data) as view:
+        for pos in range(0, len(data), block_size):
+            decoder.decode(view[pos:pos + block_size])
+    return time.time() - start_time
+
+def bench_write(hp, stream, data):
+    info = hp.sqhelper._get_capture_info()
+    block_size = (capfile.DECODE_BLOCK_GROUPS
+                  * info.get_decoder().get_group_size())
+    writer = capfile.FORMATS[hp.sqhelper.output_format](
+        hp.sqhelper.csvfilename, info)
+    start_time = time.time()
+    with memoryview(data) as view:
+        for pos in range(0, len(data), block_size):
+            writer.write_data(view[pos:pos + block_size])
+    writer.close()
+    return time.time() - start_time
+
+def bench_e2e(hp, stream, data):
+    sqhelper = hp.sqhelper
+    with contextlib.redirect_stdout(io.StringIO()):
+        start_time = time.time()
+        sqhelper._start_frame(sqhelper.csvfilename)
+        sqhelper._note_frame_slot(0)
+        run_stream(stream, sqhelper._note_frame_data)
+        sqhelper._finish_frame(0)
+        elapsed = time.time() - start_time
+    return elapsed
+
+STAGE_FUNCS = {"framing": bench_framing, "decode": bench_decode,
+               "write": bench_write, "e2e": bench_e2e}
+
+
+######################################################################
+# Reporting
+######################################################################
+
+def run_config(name, args, stages, data_size, fmt, tmpdir):
+    filename = os.path.join(tmpdir, "bench." + fmt)
+    hp = setup_processor(args, fmt, filename)
+    stream, data = build_stream(hp, data_size)
+    mps = hcap.DEPOSIT_TYPES[hp.sqhelper.meas_bits][0]
+    measurements = (len(data) // hcap.BYTES_PER_SAMPLE) * mps
+    results = {}
+    for stage in stages:
+        elapsed = STAGE_FUNCS[stage](hp, stream, data)
+        nbytes = len(data)
+        if stage == "framing":
+            nbytes = len(stream)
+        results[stage] = {"mbps": nbytes / elapsed / 1000000.,
+                          "samples": measurements / elapsed}
+    return results
+
+def format_results(name, results, baseline, link_rate):
+    out = ["%-26s" % (name,)]
+    for stage, res in sorted(results.items(),
+                             key=lambda i: STAGES.index(i[0])):
+        desc = "%s=%.1fMB/s(%.1fMs/s)" % (stage, res["mbps"],
+                                          res["samples"] / 1000000.)
+        base = baseline.get(name, {}).get(stage)
+        if base is not None:
+            desc += "[x%.2f]" % (res["mbps"] / base["mbps"],)
+        if res["mbps"] * 1000000. < link_rate:
+            desc += "*"
+        out.append(desc)
+    return " ".join(out)
+
+def find_regressions(all_results, baseline, threshold):
+    regressions = []
+    for name, results in all_results.items():
+        for stage, res in results.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is not None and res["mbps"] < base["mbps"] * threshold:
+                regressions.append("%s %s: %.1fMB/s vs %.1fMB/s"
+                                   % (name, stage, res["mbps"], base["mbps"]))
+    return regressions
+
+def parse_list(desc, conv=str):
+    return [conv(v.strip()) for v in desc.split(',') if v.strip()]
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--stages", type="string", default=",".join(STAGES),
+                    help="stages to benchmark (%s)" % (",".join(STAGES),))
+    opts.add_option("--bits", type="string", default="8,12,6",
+                    help="bit modes to test")
+    opts.add_option("--channels", type="string", default="1,2,3,4",
+                    help="number of channels to test")
+    opts.add_option("--rates", type="string", default="125Mhz,25Mhz,2.5Mhz",
+                    help="query rates to test (250Mhz is always tested)")
+    opts.add_option("--size", type="int", default=2000000,
+                    help="bytes of sample queue data per test")
+    opts.add_option("--format", type="choice", default="csv",
+                    choices=sorted(capfile.FORMATS.keys()),
+                    help="output format for write and e2e stages")
+    opts.add_option("--link-rate", type="float", default=LINK_RATE,
+                    help="mark stages slower than this rate (bytes/s)")
+    opts.add_option("--baseline", type="string",
+                    help="compare against results in baseline file")
+    opts.add_option("--save-baseline", type="string",
+                    help="store results in baseline file")
+    opts.add_option("--threshold", type="float", default=0.9,
+                    help="report regressions below this fraction of baseline")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("No arguments expected")
+    stages = parse_list(options.stages)
+    for stage in stages:
+        if stage not in STAGE_FUNCS:
+            opts.error("Unknown stage '%s'" % (stage,))
+    configs = build_configs(parse_list(options.bits, int),
+                            parse_list(options.channels, int),
+                            parse_list(options.rates))
+    baseline = {}
+    if options.baseline:
+        with io.open(options.baseline, "r") as f:
+            baseline = json.load(f)
+    # Run benchmarks
+    all_results = {}
+    tmpdir = tempfile.mkdtemp(prefix="hcap_bench")
+    try:
+        for name, args in configs:
+            results = run_config(name, args, stages, options.size,
+                                 options.format, tmpdir)
+            all_results[name] = results
+            sys.stdout.write(format_results(name, results, baseline,
+                                            options.link_rate) + "\n")
+            sys.stdout.flush()
+    finally:
+        for fname in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, fname))
+        os.rmdir(tmpdir)
+    sys.stdout.write("(* indicates a rate below %.1fMB/s)\n"
+                     % (options.link_rate / 1000000.,))
+    if options.save_baseline:
+        with io.open(options.save_baseline, "w") as f:
+            f.write(json.dumps(all_results, indent=1, sort_keys=True))
+    if baseline:
+        regressions = find_regressions(all_results, baseline,
+                                       options.threshold)
+        for r in regressions:
+            sys.stdout.write("REGRESSION: %s\n" % (r,))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
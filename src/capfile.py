@@ -0,0 +1,607 @@
+# Haasoscope capture file output formats
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import io, os, math, json, struct, mmap, zipfile, collections
+import multiprocessing
+import numpy
+import sqdecode
+
+BYTES_PER_SAMPLE = sqdecode.BYTES_PER_SAMPLE
+
+# Number of sample queue groups to decode at a time
+DECODE_BLOCK_GROUPS = 16384
+
+
+######################################################################
+# Capture description
+######################################################################
+
+# Parameters needed to decode (and describe) a capture
+class CaptureInfo:
+    def __init__(self, params):
+        self.params = params
+        self.fpga_freq = params['fpga_freq']
+        self.channel_div = params['channel_div']
+        self.interleave = params['interleave']
+        self.meas_bits = params['meas_bits']
+        self.meas_mask = params['meas_mask']
+        self.do_meas_sum = params['do_meas_sum']
+        # List of (ch, base_v, adc_factor) for each reported channel
+        self.channels = [tuple(c) for c in params['channels']]
+    def get_params(self):
+        return dict(self.params)
+    def get_decoder(self):
+        meas_mult = 1.
+        if self.do_meas_sum:
+            meas_mult = 1. / self.channel_div
+        channels = [(ch, base_v, adc_factor * meas_mult)
+                    for ch, base_v, adc_factor in self.channels]
+        return sqdecode.SampleDecoder(self.meas_bits, self.meas_mask,
+                                      channels, self.interleave)
+    def get_sample_time(self):
+        stime = float(self.channel_div) / self.fpga_freq
+        if self.interleave:
+            stime /= 2.
+        return stime
+    def get_header_lines(self):
+        hdrs = ["; HSoft data capture '%s'" % (self.params['start_time'],)]
+        hdrs.append(";")
+        for sts in self.params['status']:
+            hdrs.extend([("; " + s).strip() for s in sts.split('\n')])
+        return hdrs
+
+
+######################################################################
+# Output formats
+######################################################################
+
+# Conversion of sample queue data to per-channel voltages
+class VoltsEncoder:
+    def __init__(self, info):
+        self.decoder = info.get_decoder()
+        self.group_lines = self.decoder.get_meas_per_sample()
+        if info.interleave:
+            self.group_lines *= 2
+    def get_lines(self, data):
+        return (len(data) // self.decoder.get_group_size()) * self.group_lines
+    def encode(self, data, line_num):
+        return self.decoder.report_volts(self.decoder.decode(data))
+
+# Build csv lines from a table of time text and a table of padded
+# field text ('idx' selects the field text of each column of each line)
+def build_csv_lines(times, field_text, idx, line_end):
+    count = len(idx)
+    if not count:
+        return b""
+    # Fill a table of padded fields and then remove the padding
+    tw = times.shape[1]
+    vw = field_text.shape[1]
+    ew = len(line_end)
+    out = numpy.empty((count, tw + idx.shape[1] * vw + ew), numpy.uint8)
+    out[:, :tw] = times
+    for i in range(idx.shape[1]):
+        out[:, tw + i * vw:tw + (i + 1) * vw] = numpy.take(
+            field_text, idx[:, i], 0)
+    out[:, -ew:] = line_end
+    return out[out != 0].tobytes()
+
+# Conversion of sample queue data to csv text
+class CSVEncoder(VoltsEncoder):
+    def __init__(self, info):
+        VoltsEncoder.__init__(self, info)
+        self.stime = info.get_sample_time()
+        self.interleave = info.interleave
+        self.channels = self.decoder.channels
+        # Lines are built from a table containing the text of every
+        # possible measurement (entries are padded with nul characters)
+        codes = numpy.arange(info.meas_mask + 1)
+        volts = self.decoder.codes_to_volts(
+            numpy.repeat(codes[:, None], len(self.channels), 1))
+        self.volt_text = self._build_table(
+            [",%.6f" % (v,) for v in volts.T.ravel().tolist()])
+        self.volt_offsets = numpy.arange(4) * len(codes)
+        line_end = b"\n"
+        if self.interleave:
+            line_end = b",0,0\n"
+        self.line_end = numpy.frombuffer(line_end, numpy.uint8)
+        self.frac_text = self._build_table(["%03d" % (i,)
+                                            for i in range(1000)])
+        # Times are calculated arithmetically if the sample time is an
+        # exact number of nanoseconds
+        self.stime_ns = int(round(self.stime * 1000000000.))
+        if self.stime_ns / 1000000000. != self.stime:
+            self.stime_ns = 0
+    def _build_table(self, strs):
+        arr = numpy.array([s.encode() for s in strs])
+        return arr.view(numpy.uint8).reshape(len(strs), -1)
+    def encode_times(self, line_num, count):
+        # Very large times are not exact in floating point
+        end_ns = (line_num + count) * self.stime_ns
+        if not self.stime_ns or end_ns >= 1 << 50:
+            times = numpy.arange(line_num, line_num + count) * self.stime
+            return self._build_table(["%.9f" % (t,) for t in times.tolist()])
+        # Generate the "%.9f" text of each time from its integer parts
+        ns = (numpy.arange(line_num, line_num + count, dtype=numpy.int64)
+              * self.stime_ns)
+        secs, frac = numpy.divmod(ns, 1000000000)
+        sec_digits = len(str(int(secs[-1])))
+        out = numpy.empty((count, sec_digits + 10), numpy.uint8)
+        scale = 10**numpy.arange(sec_digits - 1, -1, -1, dtype=numpy.int64)
+        out[:, :sec_digits] = (secs[:, None] // scale) % 10 + ord('0')
+        out[:, :sec_digits - 1][secs[:, None] < scale[:-1]] = 0
+        out[:, sec_digits] = ord('.')
+        for i, div in enumerate([1000000, 1000, 1]):
+            pos = sec_digits + 1 + i * 3
+            out[:, pos:pos + 3] = numpy.take(self.frac_text,
+                                             (frac // div) % 1000, 0)
+        return out
+    def get_text_index(self, data):
+        # Return the volt_text entry of each column of each line
+        codes = self.decoder.decode_codes(data)
+        idx = numpy.empty((len(codes), 4), numpy.intp)
+        idx[:] = self.volt_offsets
+        idx[:, self.channels] += codes
+        if self.interleave:
+            idx = idx.reshape(-1, 2)
+        return idx
+    def encode(self, data, line_num):
+        idx = self.get_text_index(data)
+        times = self.encode_times(line_num, len(idx))
+        return build_csv_lines(times, self.volt_text, idx, self.line_end)
+
+# Comma separated values (text) output
+class CSVWriter:
+    ENCODER = CSVEncoder
+    def __init__(self, filename, info):
+        self.info = info
+        self.encoder = self.ENCODER(info)
+        decoder = info.get_decoder()
+        self.line_num = 0
+        hdr_desc = ["unused%d" % (ch,) for ch in range(4)]
+        for ch in decoder.get_report_channels():
+            hdr_desc[ch] = "ch%d" % (ch,)
+        hdrs = info.get_header_lines()
+        hdrs.append("time,%s" % (",".join(hdr_desc)))
+        hdrs.append("")
+        self.csvf = io.open(filename, "wb")
+        self.csvf.write("\n".join(hdrs).encode())
+    def write_data(self, data):
+        encoder = self.encoder
+        self.write_encoded(encoder.encode(data, self.line_num),
+                           encoder.get_lines(data))
+    def write_encoded(self, text, lines):
+        self.csvf.write(text)
+        self.line_num += lines
+    def close(self):
+        self.csvf.write(b"; End of capture (%d data lines)\n"
+                        % (self.line_num,))
+        self.csvf.close()
+
+# Raw sample queue data with a metadata header
+RAW_MAGIC = b"HSOFTRAW"
+RAW_HEADER_SIZE = 4096
+
+def build_raw_header(params):
+    hdr = RAW_MAGIC + json.dumps(params, sort_keys=True).encode()
+    if len(hdr) >= RAW_HEADER_SIZE:
+        raise ValueError("Raw capture header too large")
+    return hdr + b" " * (RAW_HEADER_SIZE - len(hdr) - 1) + b"\n"
+
+# Minimum size of the memory mapped region of a raw file
+RAW_MIN_MAP = 1024 * 1024
+
+# Raw data is written directly to a preallocated memory mapped file.
+# The data may optionally contain unaligned queue entries at its start
+# (as indicated by the 'skip_start' header parameter).
+class RawWriter:
+    def __init__(self, filename, info, size_hint=0):
+        self.params = info.get_params()
+        self.params['skip_start'] = 0
+        self.data_bytes = 0
+        self.rawf = io.open(filename, "w+b")
+        self.mm = None
+        self._map(RAW_HEADER_SIZE + max(RAW_MIN_MAP, size_hint))
+        self._write_header()
+    def _map(self, size):
+        if self.mm is not None:
+            self.mm.close()
+        self.rawf.truncate(size)
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.rawf.fileno(), 0, size)
+            except OSError:
+                pass
+        self.mm = mmap.mmap(self.rawf.fileno(), size)
+    def _write_header(self):
+        self.params['data_bytes'] = self.data_bytes
+        self.mm[:RAW_HEADER_SIZE] = build_raw_header(self.params)
+    def note_skip_start(self, skip_start):
+        self.params['skip_start'] = skip_start
+    def write_data(self, data):
+        pos = RAW_HEADER_SIZE + self.data_bytes
+        end = pos + len(data)
+        if end > len(self.mm):
+            self._map(max(end, 2 * len(self.mm)))
+        self.mm[pos:end] = data
+        self.data_bytes += len(data)
+    def close(self):
+        self._write_header()
+        self.mm.close()
+        self.rawf.truncate(RAW_HEADER_SIZE + self.data_bytes)
+        self.rawf.close()
+
+# Helper to write a single numpy ".npy" file with an unknown final length
+class NPYArrayFile:
+    HEADER_SIZE = 128
+    def __init__(self, filename, dtype):
+        self.dtype = numpy.dtype(dtype)
+        self.count = 0
+        self.npyf = io.open(filename, "wb")
+        self._write_header()
+    def _write_header(self):
+        hdr = ("{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }"
+               % (self.dtype.str, self.count))
+        hdr = hdr.ljust(self.HEADER_SIZE - 10 - 1) + "\n"
+        self.npyf.seek(0)
+        self.npyf.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(hdr))
+                        + hdr.encode())
+    def write(self, arr):
+        self.npyf.write(arr.astype(self.dtype).tobytes())
+        self.count += len(arr)
+    def close(self):
+        self._write_header()
+        self.npyf.close()
+
+# Per-channel numpy arrays (one "<name>_chN.npy" file per channel)
+class NPYWriter:
+    ENCODER = VoltsEncoder
+    def __init__(self, filename, info):
+        self.encoder = VoltsEncoder(info)
+        decoder = info.get_decoder()
+        filename = os.path.splitext(filename)[0]
+        self.report_channels = decoder.get_report_channels()
+        self.npy_files = [NPYArrayFile("%s_ch%d.npy" % (filename, ch), "<f4")
+                          for ch in self.report_channels]
+        # Write capture description to a separate text file
+        hdrs = info.get_header_lines()
+        hdrs.append("; sample_time=%.12f" % (info.get_sample_time(),))
+        for ch in self.report_channels:
+            hdrs.append("; ch%d=%s_ch%d.npy" % (ch, filename, ch))
+        hdrs.append("")
+        infof = io.open(filename + "_info.txt", "w")
+        infof.write("\n".join(hdrs))
+        infof.close()
+    def write_data(self, data):
+        self.write_encoded(self.encoder.encode(data, 0), 0)
+    def write_encoded(self, volts, lines):
+        for i, npyf in enumerate(self.npy_files):
+            npyf.write(volts[:, i])
+    def close(self):
+        for npyf in self.npy_files:
+            npyf.close()
+
+# Sigrok session (".sr") file
+class SigrokWriter:
+    ENCODER = VoltsEncoder
+    def __init__(self, filename, info):
+        self.encoder = VoltsEncoder(info)
+        decoder = info.get_decoder()
+        self.report_channels = decoder.get_report_channels()
+        self.chunk = 0
+        self.zf = zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED,
+                                  allowZip64=True)
+        self.zf.writestr("version", "2")
+        samplerate = int(round(1. / info.get_sample_time()))
+        meta = ["[global]", "sigrok version=0.5.2", "",
+                "[device 1]", "samplerate=%d" % (samplerate,),
+                "total probes=0",
+                "total analog=%d" % (len(self.report_channels),)]
+        for i, ch in enumerate(self.report_channels):
+            meta.append("analog%d=ch%d" % (i + 1, ch))
+        meta.append("")
+        self.zf.writestr("metadata", "\n".join(meta))
+    def write_data(self, data):
+        self.write_encoded(self.encoder.encode(data, 0), 0)
+    def write_encoded(self, volts, lines):
+        self.chunk += 1
+        for i in range(len(self.report_channels)):
+            self.zf.writestr("analog-1-%d-%d" % (i + 1, self.chunk),
+                             volts[:, i].astype("<f4").tobytes())
+    def close(self):
+        self.zf.close()
+
+# Default number of lines per channel in an envelope summary
+DEFAULT_ENVELOPE_POINTS = 4000
+
+def get_envelope_filename(filename):
+    return os.path.splitext(filename)[0] + "_envelope.csv"
+
+# Per-channel min/max/mean summary over buckets of samples (text)
+class EnvelopeWriter:
+    ENCODER = VoltsEncoder
+    def __init__(self, filename, info, points=DEFAULT_ENVELOPE_POINTS):
+        self.encoder = VoltsEncoder(info)
+        decoder = info.get_decoder()
+        self.stime = info.get_sample_time()
+        self.report_channels = decoder.get_report_channels()
+        # The buckets cover the preface and the frame
+        params = info.get_params()
+        total = (params.get('preface_time', 0.)
+                 + params.get('frame_time', 0.)) / self.stime
+        self.bucket_size = max(1, int(math.ceil(total / max(1, points))))
+        self.pending = numpy.zeros((0, len(self.report_channels)))
+        self.bucket_num = 0
+        hdrs = info.get_header_lines()
+        hdrs.append("; Envelope of %d samples per line" % (self.bucket_size,))
+        hdr_desc = ["time"]
+        for ch in self.report_channels:
+            hdr_desc.extend(["ch%d_min" % (ch,), "ch%d_max" % (ch,),
+                             "ch%d_mean" % (ch,)])
+        hdrs.append(",".join(hdr_desc))
+        hdrs.append("")
+        self.fmt = ["%.9f"] + ["%.6f"] * (3 * len(self.report_channels))
+        self.csvf = io.open(filename, "w")
+        self.csvf.write("\n".join(hdrs))
+    def _write_buckets(self, volts, bucket_size):
+        nc = len(self.report_channels)
+        buckets = volts.reshape(-1, bucket_size, nc)
+        count = buckets.shape[0]
+        table = numpy.empty((count, 1 + 3 * nc))
+        table[:, 0] = ((numpy.arange(count) + self.bucket_num)
+                       * self.bucket_size * self.stime)
+        table[:, 1::3] = buckets.min(axis=1)
+        table[:, 2::3] = buckets.max(axis=1)
+        table[:, 3::3] = buckets.mean(axis=1)
+        numpy.savetxt(self.csvf, table, fmt=self.fmt, delimiter=",")
+        self.bucket_num += count
+    def write_data(self, data):
+        self.write_encoded(self.encoder.encode(data, 0), 0)
+    def write_encoded(self, volts, lines):
+        if len(self.pending):
+            volts = numpy.concatenate([self.pending, volts])
+        bucket_size = self.bucket_size
+        end_pos = len(volts) - len(volts) % bucket_size
+        if end_pos:
+            self._write_buckets(volts[:end_pos], bucket_size)
+        self.pending = volts[end_pos:].copy()
+    def close(self):
+        if len(self.pending):
+            self._write_buckets(self.pending, len(self.pending))
+        self.csvf.write("; End of capture (%d envelope lines)\n"
+                        % (self.bucket_num,))
+        self.csvf.close()
+
+# Send data to several output writers
+class MultiWriter:
+    def __init__(self, writers):
+        self.writers = writers
+    def write_data(self, data):
+        for writer in self.writers:
+            writer.write_data(data)
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+FORMATS = {
+    "csv": CSVWriter, "raw": RawWriter, "npy": NPYWriter,
+    "sigrok": SigrokWriter, "envelope": EnvelopeWriter,
+}
+
+
+######################################################################
+# In-memory captures
+######################################################################
+
+# Measurement codes of each channel along with their scaling
+class Capture:
+    def __init__(self, info, codes):
+        # The 'codes' parameter is a (lines, queue_channels) array
+        self.info = info
+        self.sample_time = info.get_sample_time()
+        decoder = info.get_decoder()
+        scale = {ch: (bv, af) for ch, bv, af in zip(
+            decoder.channels, decoder.base_v.tolist(),
+            decoder.adc_factor.tolist())}
+        # In interleave mode ch2 and ch3 provide the odd samples of ch0/ch1
+        self.codes = {}
+        self.scales = {}
+        for ch in decoder.get_report_channels():
+            src_channels = [ch]
+            if info.interleave:
+                src_channels.append(ch + 2)
+            arr = numpy.zeros((len(codes), len(src_channels)), codes.dtype)
+            for i, src_ch in enumerate(src_channels):
+                if src_ch in decoder.channels:
+                    arr[:, i] = codes[:, decoder.channels.index(src_ch)]
+            self.codes[ch] = arr.ravel()
+            self.scales[ch] = numpy.array([scale.get(src_ch, (0., 0.))
+                                           for src_ch in src_channels])
+        self.num_samples = len(codes) * (1 + info.interleave)
+    def get_info(self):
+        return self.info
+    def get_channels(self):
+        return sorted(self.codes.keys())
+    def get_sample_time(self):
+        return self.sample_time
+    def get_num_samples(self):
+        return self.num_samples
+    def get_codes(self, ch):
+        return self.codes[ch]
+    def get_scale(self, ch):
+        # Returns a list of (base_v, adc_factor) used for each sample
+        # (interleaved captures alternate between two adcs)
+        return [tuple(s) for s in self.scales[ch].tolist()]
+    def _get_range(self, start, count):
+        start = max(0, min(start, self.num_samples))
+        if count is None:
+            return start, self.num_samples
+        return start, max(start, min(start + count, self.num_samples))
+    def get_times(self, start=0, count=None):
+        start, end = self._get_range(start, count)
+        return numpy.arange(start, end) * self.sample_time
+    def get_volts(self, ch, start=0, count=None):
+        start, end = self._get_range(start, count)
+        codes = self.codes[ch][start:end]
+        scales = self.scales[ch]
+        if len(scales) == 1:
+            return scales[0, 0] + codes * scales[0, 1]
+        sel = numpy.arange(start, end) % len(scales)
+        return scales[sel, 0] + codes * scales[sel, 1]
+
+# Output "file" that stores measurement codes in a Capture object
+class CaptureWriter:
+    def __init__(self, info):
+        self.info = info
+        self.decoder = info.get_decoder()
+        self.dtype = numpy.uint16
+        if info.meas_mask <= 0xff:
+            self.dtype = numpy.uint8
+        self.blocks = []
+        self.capture = None
+    def write_data(self, data):
+        codes = self.decoder.decode_codes(data)
+        self.blocks.append(codes.astype(self.dtype))
+    def close(self):
+        nc = self.decoder.num_channels
+        codes = numpy.concatenate(self.blocks + [numpy.zeros((0, nc),
+                                                             self.dtype)])
+        self.blocks = []
+        self.capture = Capture(self.info, codes)
+    def get_capture(self):
+        return self.capture
+
+
+######################################################################
+# Parallel decoding
+######################################################################
+
+# Encoder used by each worker process
+worker_encoder = None
+
+def _init_worker(encoder_class, params):
+    global worker_encoder
+    worker_encoder = encoder_class(CaptureInfo(params))
+
+def _encode_worker(data, line_num):
+    return worker_encoder.encode(data, line_num)
+
+# Decode (and format) blocks of data on a pool of worker processes
+class ParallelWriter:
+    def __init__(self, writer, info, jobs):
+        self.writer = writer
+        encoder_class = writer.ENCODER
+        self.encoder = encoder_class(info)
+        self.pool = multiprocessing.Pool(jobs, _init_worker,
+                                         (encoder_class, info.get_params()))
+        self.max_pending = 2 * jobs
+        self.pending = collections.deque()
+        self.line_num = 0
+    def _write_next(self):
+        res, lines = self.pending.popleft()
+        self.writer.write_encoded(res.get(), lines)
+    def write_data(self, data):
+        lines = self.encoder.get_lines(data)
+        res = self.pool.apply_async(_encode_worker,
+                                    (bytes(data), self.line_num))
+        self.pending.append((res, lines))
+        self.line_num += lines
+        # Results are written in order
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+    def close(self):
+        try:
+            while self.pending:
+                self._write_next()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+        self.writer.close()
+
+def create_writer(fmt, filename, info, jobs=1):
+    writer = FORMATS[fmt](filename, info)
+    if jobs > 1 and hasattr(writer, "ENCODER"):
+        writer = ParallelWriter(writer, info, jobs)
+    return writer
+
+
+######################################################################
+# Raw file reading
+######################################################################
+
+# Access to a raw file (data is only read from the memory mapped file
+# as it is decoded)
+class RawReader:
+    def __init__(self, filename):
+        self.rawf = io.open(filename, "rb")
+        hdr = self.rawf.read(RAW_HEADER_SIZE)
+        if len(hdr) != RAW_HEADER_SIZE or not hdr.startswith(RAW_MAGIC):
+            raise ValueError("File '%s' is not a raw capture" % (filename,))
+        self.params = json.loads(hdr[len(RAW_MAGIC):].decode())
+        self.info = CaptureInfo(self.params)
+        self.decoder = decoder = self.info.get_decoder()
+        self.group_size = decoder.get_group_size()
+        self.group_samples = decoder.get_meas_per_sample()
+        if self.info.interleave:
+            self.group_samples *= 2
+        # Locate the aligned sample data
+        skip_bytes = self.params.get('skip_start', 0) * BYTES_PER_SAMPLE
+        data_bytes = max(0, self.params['data_bytes'] - skip_bytes)
+        self.data_start = RAW_HEADER_SIZE + skip_bytes
+        self.data_bytes = data_bytes - data_bytes % self.group_size
+        self.mm = mmap.mmap(self.rawf.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < self.data_start + self.data_bytes:
+            raise ValueError("Raw capture '%s' is truncated" % (filename,))
+    def get_info(self):
+        return self.info
+    def get_num_samples(self):
+        return (self.data_bytes // self.group_size) * self.group_samples
+    def get_trigger_sample(self):
+        # Sample number of the trigger (to within one group of samples)
+        entries = (self.params.get('frame_prefix', 0)
+                   - self.params.get('skip_start', 0))
+        groups = max(0, entries // self.decoder.num_channels)
+        return min(groups * self.group_samples, self.get_num_samples())
+    def read_sample_data(self, start, count):
+        # Return (offset, data) - the sample queue data of the groups
+        # containing the requested samples and the position of the
+        # first requested sample within the decoded data
+        start = max(0, start)
+        end = min(start + count, self.get_num_samples())
+        if end <= start:
+            return 0, self.mm[0:0]
+        group_start = start // self.group_samples
+        group_end = (end + self.group_samples - 1) // self.group_samples
+        pos = self.data_start + group_start * self.group_size
+        data = self.mm[pos:pos + (group_end - group_start) * self.group_size]
+        return start - group_start * self.group_samples, data
+    def read_samples(self, start, count):
+        # Decode only the groups containing the requested samples and
+        # return a (samples, report_channels) array of voltages
+        offset, data = self.read_sample_data(start, count)
+        volts = self.decoder.report_volts(self.decoder.decode(data))
+        return volts[offset:offset + max(0, count)]
+    def read_time_range(self, start_time, end_time):
+        # Decode the samples between two times (in seconds from the
+        # start of the capture) - returns (first_sample, volts)
+        stime = self.info.get_sample_time()
+        start = max(0, int(math.ceil(start_time / stime - .000001)))
+        end = int(math.floor(end_time / stime + .000001)) + 1
+        return start, self.read_samples(start, end - start)
+    def read_blocks(self):
+        block_size = DECODE_BLOCK_GROUPS * self.group_size
+        end = self.data_start + self.data_bytes
+        for pos in range(self.data_start, end, block_size):
+            yield self.mm[pos:min(pos + block_size, end)]
+    def close(self):
+        self.mm.close()
+        self.rawf.close()
+
+def convert_raw(rawfilename, outfilename, fmt="csv", jobs=1):
+    reader = RawReader(rawfilename)
+    writer = create_writer(fmt, outfilename, reader.get_info(), jobs)
+    for data in reader.read_blocks():
+        writer.write_data(data)
+    writer.close()
+    reader.close()
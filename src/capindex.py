@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Index of threshold crossings in a raw capture file
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, io
+import numpy
+import capfile, hcap
+
+# Event types (using the same semantics as the fpga trigger codes)
+EVENT_TYPES = {0x05: "falling", 0x07: "rising", 0x01: "below", 0x03: "above"}
+
+def get_index_filename(rawfilename):
+    return os.path.splitext(rawfilename)[0] + "_index.npz"
+
+
+######################################################################
+# Index creation
+######################################################################
+
+# Round a threshold voltage to an adc code (as AFHelper does for triggers)
+def calc_thresh_code(volt, base_v, adc_factor):
+    return max(0, min(255, int((volt - base_v) / adc_factor + 0.5)))
+
+# Compare the measurements of each channel to its threshold
+class ThresholdChecker:
+    def __init__(self, info, thresholds):
+        # The 'thresholds' parameter is a dict of {channel: volt}
+        self.decoder = info.get_decoder()
+        # Measurements are the sum of several adc codes when averaging
+        meas_mult = 1
+        if info.do_meas_sum:
+            meas_mult = info.channel_div
+        thresh = []
+        for ch, base_v, adc_factor in info.channels:
+            # In interleave mode ch2 and ch3 provide samples of ch0/ch1
+            if info.interleave:
+                ch &= 1
+            code = 0
+            if ch in thresholds:
+                code = calc_thresh_code(thresholds[ch], base_v, adc_factor)
+            thresh.append(code * meas_mult)
+        self.thresh = numpy.array(thresh, numpy.uint32)
+    def check(self, data):
+        # Returns a (samples, report_channels) array that is true for
+        # samples above the threshold - the fpga trigger uses the same
+        # "thresh > adc" test (adc codes decrease as the voltage rises)
+        decoder = self.decoder
+        codes = decoder.decode_codes(data)
+        above = numpy.zeros((len(codes), 4), bool)
+        above[:, decoder.channels] = codes < self.thresh
+        return decoder.report_volts(above)
+
+# Track the crossings of a threshold for one channel
+class CrossingFinder:
+    def __init__(self):
+        self.initial_above = self.last_above = None
+        self.rising = []
+        self.falling = []
+    def note_above(self, start, above):
+        if not len(above):
+            return
+        if self.last_above is None:
+            self.initial_above = self.last_above = bool(above[0])
+        prev = numpy.empty(len(above), bool)
+        prev[0] = self.last_above
+        prev[1:] = above[:-1]
+        changes = numpy.nonzero(above != prev)[0]
+        rising = above[changes]
+        self.rising.append(changes[rising] + start)
+        self.falling.append(changes[~rising] + start)
+        self.last_above = bool(above[-1])
+    def get_events(self):
+        rising = numpy.concatenate(self.rising + [numpy.zeros(0, int)])
+        falling = numpy.concatenate(self.falling + [numpy.zeros(0, int)])
+        rising = rising.astype(numpy.int64)
+        falling = falling.astype(numpy.int64)
+        # An edge trigger requires the inverse condition first, but a
+        # level trigger may also occur on the first sample
+        first = numpy.zeros(1, numpy.int64)
+        above, below = rising, falling
+        if self.initial_above:
+            above = numpy.concatenate([first, rising])
+        elif self.initial_above is not None:
+            below = numpy.concatenate([first, falling])
+        return {"rising": rising, "falling": falling,
+                "above": above, "below": below}
+
+# Scan a raw capture and store all threshold crossings in an index file
+def build_index(rawfilename, thresholds, indexfilename=None):
+    # The 'thresholds' parameter is a dict of {channel: volt}
+    if indexfilename is None:
+        indexfilename = get_index_filename(rawfilename)
+    reader = capfile.RawReader(rawfilename)
+    info = reader.get_info()
+    decoder = info.get_decoder()
+    report_channels = decoder.get_report_channels()
+    finders = {}
+    for ch, volt in thresholds.items():
+        if ch not in report_channels:
+            raise hcap.error("Channel %d not found in capture" % (ch,))
+        finders[ch] = CrossingFinder()
+    checker = ThresholdChecker(info, thresholds)
+    pos = 0
+    for data in reader.read_blocks():
+        above = checker.check(data)
+        for ch, finder in finders.items():
+            finder.note_above(pos, above[:, report_channels.index(ch)])
+        pos += len(above)
+    reader.close()
+    meta = {'raw_file': os.path.basename(rawfilename),
+            'start_time': info.get_params()['start_time'],
+            'data_bytes': info.get_params()['data_bytes'],
+            'samples': pos, 'sample_time': info.get_sample_time(),
+            'thresholds': {"ch%d" % (ch,): v for ch, v in thresholds.items()}}
+    arrays = {"meta": numpy.array(json.dumps(meta))}
+    for ch, finder in finders.items():
+        for etype, events in finder.get_events().items():
+            arrays["ch%d_%s" % (ch, etype)] = events
+    with io.open(indexfilename, "wb") as f:
+        numpy.savez(f, **arrays)
+    return CaptureIndex(indexfilename)
+
+
+######################################################################
+# Index access
+######################################################################
+
+class CaptureIndex:
+    def __init__(self, filename):
+        with numpy.load(filename, allow_pickle=False) as npz:
+            self.meta = json.loads(str(npz["meta"]))
+            self.events = {k: npz[k] for k in npz.files if k != "meta"}
+    def get_meta(self):
+        return dict(self.meta)
+    def get_channels(self):
+        return sorted([int(ch[2:]) for ch in self.meta['thresholds']])
+    def get_events(self, channel, event_type):
+        # Return a sorted array of sample numbers
+        key = "ch%d_%s" % (channel, event_type)
+        if key not in self.events:
+            raise hcap.error("No '%s' events indexed for channel %d"
+                             % (event_type, channel))
+        return self.events[key]
+    def check_reader(self, reader):
+        params = reader.get_info().get_params()
+        if (params['start_time'] != self.meta['start_time']
+            or params['data_bytes'] != self.meta['data_bytes']):
+            raise hcap.error("Index does not match capture file")
+    def read_event(self, reader, channel, event_type, num, before, after):
+        # Decode the samples around the Nth event (returns the sample
+        # number of the first sample and an array of voltages)
+        self.check_reader(reader)
+        events = self.get_events(channel, event_type)
+        if num < 0 or num >= len(events):
+            raise hcap.error("Event %d not found (%d %s events)"
+                             % (num, len(events), event_type))
+        pos = int(events[num])
+        start = max(0, pos - before)
+        return start, reader.read_samples(start, pos - start + after)
+
+
+######################################################################
+# Startup
+######################################################################
+
+def write_window(filename, info, start, volts):
+    stime = info.get_sample_time()
+    channels = info.get_decoder().get_report_channels()
+    hdrs = info.get_header_lines()
+    hdrs.append("time,%s" % (",".join(["ch%d" % (ch,) for ch in channels]),))
+    table = numpy.empty((len(volts), 1 + len(channels)))
+    table[:, 0] = (numpy.arange(len(volts)) + start) * stime
+    table[:, 1:] = volts
+    with io.open(filename, "w") as f:
+        f.write("\n".join(hdrs) + "\n")
+        numpy.savetxt(f, table, fmt=["%.9f"] + ["%.6f"] * len(channels),
+                      delimiter=",")
+
+def main():
+    usage = "%prog [options] <raw_file>"
+    opts = optparse.OptionParser(usage)
+    for ch in range(4):
+        opts.add_option("--ch%d" % (ch,), type="string", default=None,
+                        help="index crossings of this channel voltage")
+    opts.add_option("--event", type="int", default=None,
+                    help="extract the samples around this event number")
+    opts.add_option("--channel", type="string", default="ch0",
+                    help="channel of event to extract")
+    opts.add_option("--type", type="choice", default="falling",
+                    choices=sorted(EVENT_TYPES.values()),
+                    help="type of event to extract")
+    opts.add_option("--before", type="float", default=0.00001,
+                    help="time (in seconds) to extract prior to event")
+    opts.add_option("--after", type="float", default=0.00001,
+                    help="time (in seconds) to extract after event")
+    opts.add_option("-o", "--output", type="string", default=None,
+                    help="csv file to store extracted samples")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Must specify raw_file")
+    rawfilename = args[0]
+    indexfilename = get_index_filename(rawfilename)
+    if options.event is None:
+        # Build index
+        thresholds = {}
+        for ch in range(4):
+            desc = getattr(options, "ch%d" % (ch,))
+            if desc is not None:
+                tcode, thresholds[ch] = hcap.parse_trigger(desc)
+        if not thresholds:
+            opts.error("Must specify a channel threshold (eg, --ch0 1.0)")
+        index = build_index(rawfilename, thresholds, indexfilename)
+        for ch in index.get_channels():
+            counts = ["%s=%d" % (etype, len(index.get_events(ch, etype)))
+                      for etype in sorted(EVENT_TYPES.values())]
+            sys.stdout.write("ch%d: %s\n" % (ch, " ".join(counts)))
+        sys.stdout.write("Wrote %s\n" % (indexfilename,))
+        return
+    # Extract the samples around an event
+    if options.output is None:
+        opts.error("Must specify --output")
+    index = CaptureIndex(indexfilename)
+    reader = capfile.RawReader(rawfilename)
+    info = reader.get_info()
+    stime = info.get_sample_time()
+    channel = int(options.channel.lower().lstrip("ch"))
+    start, volts = index.read_event(
+        reader, channel, options.type, options.event,
+        int(options.before / stime), int(options.after / stime))
+    reader.close()
+    write_window(options.output, info, start, volts)
+    sys.stdout.write("Wrote %d samples to %s\n" % (len(volts), options.output))
+
+if __name__ == '__main__':
+    main()
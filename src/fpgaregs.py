@@ -68,3 +68,13 @@ PP_REGS = {
     "cur_phase": (0x02, 1),
 }
 FPGA_MODULES["pp"] = (0x03, PP_REGS)
+
+# Registers that the fpga may change (or that trigger an action when
+# written) and that must therefore never be cached by the host
+VOLATILE_REGS = [
+    ("sq", "status"), ("sq", "reg_fifo_position"), ("sq", "frame_count"),
+    ("vers", "code_version"),
+    ("adcspi", "state"), ("adcspi", "data0"), ("adcspi", "data1"),
+    ("i2c", "txr"), ("i2c", "cr"),
+    ("pp", "status"), ("pp", "cur_phase"),
+]
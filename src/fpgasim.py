@@ -0,0 +1,770 @@
+# Simulated Haasoscope fpga (for testing without hardware)
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import time, math, threading
+import numpy
+import fpgaregs, sqdecode, hcap
+
+BYTES_PER_SAMPLE = sqdecode.BYTES_PER_SAMPLE
+
+# Default simulated link speed (roughly that of the USB hi-speed adapter)
+DEFAULT_BYTE_RATE = 40000000.
+# Amount of data the link buffers while the host is not reading
+LINK_BUFFER_SIZE = 64 * 1024
+# Maximum time a read waits for data (similar to setup_serial())
+READ_TIMEOUT = 0.001
+
+# Code version reported by the simulator (matches codeversion.v)
+SIM_CODE_VERSION = 0x0000010a
+
+# Sample queue size (matches haasoscope.v)
+QUEUE_SIZE = 42 * ((9 * 1024) // 72)
+QUEUE_ADDR_MASK = (1 << (QUEUE_SIZE - 1).bit_length()) - 1
+# Maximum number of queue entries in each SAMPLE message
+MAX_MSG_ENTRIES = 96
+# Fpga clock ticks used to process a request (see wbcmd.v)
+CMD_TICKS = 4
+# Size of a request message
+REQUEST_SIZE = 10
+
+# Sample data is generated from a table that repeats after this many
+# fpga clock ticks (signal frequencies are rounded to fit the table)
+TABLE_TICKS = 4 * 1024 * 1024
+TABLE_MAX_GROUPS = 64 * 1024
+
+# Default test signals for each input: (frequency, amplitude, offset)
+# with the amplitude and offset in adc codes
+DEFAULT_SIGNALS = [
+    (10000., 100., 128.), (25000., 60., 100.),
+    (5000., 120., 128.), (100000., 30., 160.),
+]
+
+
+######################################################################
+# Register modules
+######################################################################
+
+def get_reg_byte(val, offset):
+    return (val >> (offset * 8)) & 0xff
+
+def set_reg_byte(val, offset, data):
+    shift = offset * 8
+    return (val & ~(0xff << shift)) | (data << shift)
+
+# Code version module
+class SimVersion:
+    def read(self, offset):
+        return get_reg_byte(SIM_CODE_VERSION, offset & 0x03)
+    def write(self, offset, val):
+        pass
+
+# ADC SPI module (transfers complete after a fixed time)
+class SimADCSPI:
+    SPI_TIME = 0.000020
+    def __init__(self):
+        self.data = [0, 0]
+        self.busy_until = 0.
+        self.adc_regs = {}
+    def read(self, offset):
+        if offset & 0x03 == 0:
+            return int(time.time() < self.busy_until)
+        return 0
+    def write(self, offset, val):
+        offset &= 0x03
+        if offset == 0:
+            if val & 0x01 and time.time() >= self.busy_until:
+                self.adc_regs[self.data[0]] = self.data[1]
+                self.busy_until = time.time() + self.SPI_TIME
+        elif offset >= 2:
+            self.data[offset - 2] = val
+
+# PLL phase module (phase steps complete immediately)
+class SimPLLPhase:
+    def __init__(self):
+        self.req_phase = 0
+    def get_phase(self):
+        return self.req_phase
+    def read(self, offset):
+        offset &= 0x07
+        if offset == 1 or offset == 2:
+            return self.req_phase
+        return 0
+    def write(self, offset, val):
+        if offset & 0x07 == 1:
+            self.req_phase = val
+
+# I2C module (register interface of the opencores i2c master)
+class SimI2C:
+    def __init__(self, slow_freq):
+        self.slow_freq = slow_freq
+        self.devices = {}
+        self.prer = 0xffff
+        self.ctr = self.txr = self.rxr = 0
+        self.rxack = self.busy = self.irq = 0
+        self.tip_until = 0.
+        self.dev = None
+        self.need_addr = False
+    def add_device(self, i2c_addr, dev):
+        self.devices[i2c_addr] = dev
+    def read(self, offset):
+        offset &= 0x07
+        if offset < 2:
+            return get_reg_byte(self.prer, offset)
+        if offset == 2:
+            return self.ctr
+        if offset == 3:
+            return self.rxr
+        if offset == 4:
+            tip = int(time.time() < self.tip_until)
+            return (self.rxack << 7) | (self.busy << 6) | (tip << 1) | self.irq
+        return 0
+    def write(self, offset, val):
+        offset &= 0x07
+        if offset < 2:
+            self.prer = set_reg_byte(self.prer, offset, val)
+        elif offset == 2:
+            self.ctr = val
+        elif offset == 3:
+            self.txr = val
+        elif offset == 4 and self.ctr & 0x80:
+            self._command(val)
+    def _command(self, cmd):
+        if cmd & 0x01:
+            self.irq = 0
+        if not cmd & 0xf0:
+            return
+        bit_time = 5. * (self.prer + 1) / self.slow_freq
+        bits = 0
+        if cmd & 0x80:
+            # Start (or repeated start)
+            self.busy = 1
+            self.need_addr = True
+            bits += 1
+        if cmd & 0x10:
+            # Write byte
+            bits += 9
+            if self.need_addr:
+                self.need_addr = False
+                self.dev = self.devices.get(self.txr >> 1)
+                if self.dev is not None:
+                    self.dev.start(self.txr & 0x01)
+                self.rxack = int(self.dev is None)
+            elif self.dev is not None:
+                self.rxack = int(not self.dev.write_byte(self.txr))
+            else:
+                self.rxack = 1
+        elif cmd & 0x20:
+            # Read byte
+            bits += 9
+            self.rxr = 0xff
+            if self.dev is not None:
+                self.rxr = self.dev.read_byte()
+            self.rxack = 0
+        if cmd & 0x40:
+            # Stop
+            bits += 1
+            if self.dev is not None:
+                self.dev.stop()
+            self.dev = None
+            self.busy = 0
+        self.irq = 1
+        self.tip_until = time.time() + bits * bit_time
+
+# ADC channel module (trigger and sample accumulator registers)
+class SimADCChannel:
+    def __init__(self, sq):
+        self.sq = sq
+        # Trigger
+        self.trig_enable = self.cmp_greater = self.require_inverse = 0
+        self.thresh = 0
+        # Sample accumulator
+        self.enable = self.do_adc_add = self.deposit_type = 0
+        self.acc_cnt = 0
+        self.sum_mask = self.initial_sum = 0
+    def read(self, offset):
+        offset &= 0x3f
+        if offset == 0x00:
+            return ((self.require_inverse << 2) | (self.cmp_greater << 1)
+                    | self.trig_enable)
+        if offset == 0x01:
+            return self.thresh
+        if offset == 0x20:
+            return ((self.deposit_type << 4) | (self.do_adc_add << 1)
+                    | self.enable)
+        if offset == 0x21:
+            return self.acc_cnt
+        if offset in (0x22, 0x23):
+            return get_reg_byte(self.sum_mask, offset - 0x22)
+        if offset in (0x24, 0x25):
+            return get_reg_byte(self.initial_sum, offset - 0x24)
+        return 0
+    def write(self, offset, val):
+        offset &= 0x3f
+        if offset == 0x00:
+            if not self.trig_enable or not val & 0x01:
+                self.cmp_greater = (val >> 1) & 0x01
+                self.require_inverse = (val >> 2) & 0x01
+            self.trig_enable = val & 0x01
+        elif offset == 0x01:
+            if not self.trig_enable:
+                self.thresh = val
+        elif self.sq.is_active():
+            # Accumulator registers can't be changed while sampling
+            pass
+        elif offset == 0x20:
+            self.enable = val & 0x01
+            self.do_adc_add = (val >> 1) & 0x01
+            self.deposit_type = (val >> 4) & 0x03
+        elif offset == 0x21:
+            self.acc_cnt = val
+        elif offset in (0x22, 0x23):
+            self.sum_mask = set_reg_byte(self.sum_mask, offset - 0x22, val)
+        elif offset in (0x24, 0x25):
+            self.initial_sum = set_reg_byte(self.initial_sum,
+                                            offset - 0x24, val)
+    def get_config(self):
+        return (self.enable, self.do_adc_add, self.deposit_type,
+                self.acc_cnt, self.sum_mask, self.initial_sum)
+
+
+######################################################################
+# I2C chip stand-ins
+######################################################################
+
+# MCP23017 gpio expander
+class SimMCP23017:
+    NUM_REGS = 0x16
+    def __init__(self, grounded_pins=0):
+        # Input pins with a pullup read high unless listed in grounded_pins
+        self.grounded_pins = grounded_pins
+        self.regs = bytearray(self.NUM_REGS)
+        self.regs[0x00] = self.regs[0x01] = 0xff
+        self.reg_ptr = 0
+        self.need_ptr = False
+    def get_pins(self):
+        iodir = self.regs[0x00] | (self.regs[0x01] << 8)
+        gppu = self.regs[0x0c] | (self.regs[0x0d] << 8)
+        olat = self.regs[0x14] | (self.regs[0x15] << 8)
+        return (olat & ~iodir) | (gppu & iodir & ~self.grounded_pins)
+    def start(self, is_read):
+        self.need_ptr = not is_read
+    def write_byte(self, data):
+        if self.need_ptr:
+            self.reg_ptr = data % self.NUM_REGS
+            self.need_ptr = False
+            return True
+        reg = self.reg_ptr
+        if reg in (0x12, 0x13):
+            # Writes to GPIO update the output latch
+            reg += 2
+        self.regs[reg] = data
+        self.reg_ptr = (self.reg_ptr + 1) % self.NUM_REGS
+        return True
+    def read_byte(self):
+        reg = self.reg_ptr
+        self.reg_ptr = (reg + 1) % self.NUM_REGS
+        if reg in (0x12, 0x13):
+            return get_reg_byte(self.get_pins(), reg - 0x12)
+        return self.regs[reg]
+    def stop(self):
+        pass
+
+# MCP4728 four channel DAC
+class SimMCP4728:
+    def __init__(self):
+        # Per channel (vref, power_down, gain, code)
+        self.channels = [(0, 0, 0, 0)] * 4
+        self.write_data = []
+        self.read_pos = 0
+    def get_dac(self, channel):
+        return self.channels[channel]
+    def start(self, is_read):
+        self.write_data = []
+        self.read_pos = 0
+    def write_byte(self, data):
+        self.write_data.append(data)
+        return True
+    def _encode_channel(self, channel, vref, power_down, gain, code):
+        return [0x80 | (channel << 4),
+                (vref << 7) | (power_down << 5) | (gain << 4) | (code >> 8),
+                code & 0xff]
+    def read_byte(self):
+        # Report dac registers followed by (identical) eeprom contents
+        data = []
+        for ch, info in enumerate(self.channels):
+            data.extend(self._encode_channel(ch, *info) * 2)
+        val = data[self.read_pos % len(data)]
+        self.read_pos += 1
+        return val
+    def _set_channel(self, channel, hi, lo):
+        self.channels[channel] = ((hi >> 7) & 0x01, (hi >> 5) & 0x03,
+                                  (hi >> 4) & 0x01, ((hi & 0x0f) << 8) | lo)
+    def stop(self):
+        data = self.write_data
+        self.write_data = []
+        if not data:
+            return
+        cmd = data[0]
+        if not cmd & 0xc0:
+            # Fast write (channels A-D, no vref/gain bits)
+            for ch in range(min(4, len(data) // 2)):
+                hi, lo = data[ch*2], data[ch*2 + 1]
+                vref, pd, gain, code = self.channels[ch]
+                self.channels[ch] = (vref, (hi >> 4) & 0x03, gain,
+                                     ((hi & 0x0f) << 8) | lo)
+        elif cmd & 0xf8 == 0x40 or cmd & 0xf8 == 0x58:
+            # Multi-write (or single write) of "cmd, hi, lo" triplets
+            for pos in range(0, len(data) - 2, 3):
+                cmd = data[pos]
+                self._set_channel((cmd >> 1) & 0x03, data[pos+1], data[pos+2])
+        elif cmd & 0xf8 == 0x50:
+            # Sequential write starting at a channel
+            ch = (cmd >> 1) & 0x03
+            for pos in range(1, len(data) - 1, 2):
+                if ch > 3:
+                    break
+                self._set_channel(ch, data[pos], data[pos+1])
+                ch += 1
+
+
+######################################################################
+# Sample queue
+######################################################################
+
+# Map a fpga deposit code to (measurements_per_sample, shift)
+DEPOSIT_CODES = {code: (mps, shift)
+                 for mps, shift, code in sqdecode.DEPOSIT_TYPES.values()}
+
+# Generator of sample queue entries for a channel configuration
+class SampleTable:
+    def __init__(self, channels, signals, fpga_freq, phase_ticks):
+        # 'channels' is a list of (ch, config) for each enabled channel
+        self.num_channels = nc = len(channels)
+        ch, (enable, do_adc_add, deposit_type, acc_cnt, sum_mask,
+             initial_sum) = channels[0]
+        self.meas_per_sample, meas_shift = DEPOSIT_CODES[deposit_type]
+        self.channel_div = acc_cnt + 1
+        self.ticks_per_group = self.meas_per_sample * self.channel_div
+        groups = max(1, min(TABLE_MAX_GROUPS,
+                            TABLE_TICKS // self.ticks_per_group))
+        self.period_ticks = groups * self.ticks_per_group
+        self.signals = []
+        for sig_freq, amplitude, offset in signals:
+            cycles = max(1, int(round(sig_freq * self.period_ticks
+                                      / fpga_freq)))
+            self.signals.append((cycles, amplitude, offset))
+        self.phase_ticks = phase_ticks
+        # Build table of entries (in queue order)
+        entries = numpy.zeros((groups, nc, BYTES_PER_SAMPLE), numpy.uint8)
+        for ci, (ch, config) in enumerate(channels):
+            vals = self._calc_measurements(ch, config, groups)
+            vals = vals.reshape(groups, self.meas_per_sample)
+            for j in range(self.meas_per_sample):
+                mnum = self.meas_per_sample - 1 - j
+                byte_start, shift = divmod(j * meas_shift, 8)
+                v = vals[:, mnum] << shift
+                for k in range(3):
+                    entries[:, ci, (byte_start + k) % BYTES_PER_SAMPLE] |= (
+                        (v >> (k * 8)) & 0xff).astype(numpy.uint8)
+        self.num_entries = groups * nc
+        table = entries.tobytes()
+        # Allow any message to be taken without wrapping
+        self.table = table + table[:MAX_MSG_ENTRIES * BYTES_PER_SAMPLE]
+    def _get_signal(self, ch):
+        # Return (radians_per_tick, amplitude, offset, tick_offset)
+        inp = ch
+        tick_offset = 0.
+        if self.phase_ticks and ch >= 2:
+            # Interleaving - ch2/ch3 sample the ch0/ch1 inputs
+            inp = ch - 2
+            tick_offset = self.phase_ticks
+        cycles, amplitude, offset = self.signals[inp]
+        return (2. * math.pi * cycles / self.period_ticks, amplitude, offset,
+                tick_offset)
+    def get_adc(self, ch, ticks):
+        # Return adc codes for a channel at the given (relative) times
+        rad, amplitude, offset, tick_offset = self._get_signal(ch)
+        adc = numpy.rint(offset + amplitude
+                         * numpy.sin((ticks + tick_offset) * rad))
+        return numpy.clip(adc, 0, 255).astype(numpy.int64)
+    def _calc_measurements(self, ch, config, groups):
+        enable, do_adc_add, deposit_type, acc_cnt, sum_mask, initial_sum \
+            = config
+        div = self.channel_div
+        ticks = numpy.arange(groups * self.meas_per_sample) * div
+        if do_adc_add and div > 1:
+            # Sum of a sine over 'div' ticks (ignores per-tick rounding)
+            rad, amplitude, offset, tick_offset = self._get_signal(ch)
+            gain = math.sin(div * rad / 2.) / math.sin(rad / 2.)
+            center = (ticks + tick_offset + (div - 1) / 2.) * rad
+            vals = numpy.rint(div * offset + amplitude * gain
+                              * numpy.sin(center))
+            vals = numpy.clip(vals, 0, 255 * div).astype(numpy.int64)
+        else:
+            vals = self.get_adc(ch, ticks + (div - 1))
+        if initial_sum & 0x8000:
+            initial_sum -= 0x10000
+        vals += initial_sum
+        # Emulate saturating sum masking
+        underflow = vals < 0
+        vals = numpy.where(vals > sum_mask, sum_mask, vals & sum_mask)
+        vals[underflow] = 0
+        return vals.astype(numpy.uint32)
+    def get_entries(self, index, count):
+        pos = (index % self.num_entries) * BYTES_PER_SAMPLE
+        return self.table[pos:pos + count * BYTES_PER_SAMPLE]
+    def find_trigger(self, triggers, start_tick):
+        # Find the first tick at or after start_tick that triggers
+        # 'triggers' is a list of (ch, thresh, cmp_greater, require_inverse)
+        pos = start_tick
+        end_tick = start_tick + self.period_ticks
+        block = 4096
+        while pos <= end_tick:
+            ticks = numpy.arange(pos, pos + block)
+            best = None
+            for ch, thresh, cmp_greater, require_inverse in triggers:
+                cond = (thresh > self.get_adc(ch, ticks)) == bool(cmp_greater)
+                if require_inverse:
+                    # Trigger needs a non-matching sample first
+                    inv = numpy.flatnonzero(~cond)
+                    if not len(inv):
+                        continue
+                    cond[:inv[0]] = False
+                hits = numpy.flatnonzero(cond)
+                if len(hits) and (best is None or hits[0] < best):
+                    best = hits[0]
+            if best is not None:
+                return pos + int(best)
+            pos += block
+            block = min(block * 2, 1024 * 1024)
+        return None
+
+# Sample queue module
+class SimSampleQueue:
+    def __init__(self, sim):
+        self.sim = sim
+        self.active = self.enable_trigger = self.force_trigger = 0
+        self.have_frame = 0
+        self.frame_preface = self.frame_size = self.frame_count = 0
+        self.reg_fifo_position = 0
+        self.push_counter = self.pull_counter = 0
+        self.table = None
+        self.table_cache = {}
+        self.start_tick = self.start_push = 0
+        self.trigger_tick = None
+    def is_active(self):
+        return self.active
+    def _get_table(self):
+        channels = [(ch, chan.get_config())
+                    for ch, chan in enumerate(self.sim.channels)
+                    if chan.enable]
+        if not channels:
+            return None
+        phase_ticks = (self.sim.pllphase.get_phase() * 100e-12
+                       * self.sim.fpga_freq)
+        key = (tuple(channels), phase_ticks)
+        table = self.table_cache.get(key)
+        if table is None:
+            table = SampleTable(channels, self.sim.signals,
+                                self.sim.fpga_freq, phase_ticks)
+            self.table_cache = {key: table}
+        return table
+    def _calc_push(self, tick):
+        table = self.table
+        if table is None:
+            return self.start_push
+        # The first entry after activation is a stale entry (from the
+        # last channel) - the host accounts for this when it calculates
+        # the frame position
+        groups = (tick - self.start_tick) // table.ticks_per_group
+        return self.start_push + 1 + groups * table.num_channels
+    def update(self, tick):
+        if not self.active:
+            return
+        trigger_tick = self.trigger_tick
+        if (trigger_tick is not None and tick >= trigger_tick
+            and not self.have_frame):
+            # New trigger
+            push = self._calc_push(trigger_tick)
+            self.trigger_tick = None
+            self.enable_trigger = self.force_trigger = 0
+            self.have_frame = 1
+            self.reg_fifo_position = push & 0xffffffff
+            self.pull_counter = push - self.frame_preface
+            self.frame_count = self.frame_size
+        push = self._calc_push(tick)
+        if self.have_frame and push >= self.pull_counter + QUEUE_SIZE - 2:
+            # Queue overflow - sampling stops
+            push = self.pull_counter + QUEUE_SIZE - 2
+            self.active = 0
+        self.push_counter = push
+        self._check_frame_complete()
+    def _check_frame_complete(self):
+        if self.have_frame and (not self.frame_count or (
+                not self.active and self.push_counter == self.pull_counter)):
+            self.have_frame = 0
+    def _set_status(self, val, tick):
+        if self.active or not self.have_frame:
+            if val & 0x01 and not self.active:
+                # Start sampling
+                self.table = self._get_table()
+                self.start_tick = self.sim.get_tick()
+                self.start_push = self.push_counter
+            self.active = val & 0x01
+        self.enable_trigger = (val >> 1) & 0x01
+        self.force_trigger = (val >> 2) & 0x01
+        if val & 0x80:
+            self.reg_fifo_position = self.push_counter & 0xffffffff
+        self.trigger_tick = None
+        if self.enable_trigger and self.active and self.table is not None:
+            tick = max(tick, self.start_tick)
+            if self.force_trigger:
+                self.trigger_tick = tick
+            else:
+                triggers = [(ch, chan.thresh, chan.cmp_greater,
+                             chan.require_inverse)
+                            for ch, chan in enumerate(self.sim.channels)
+                            if chan.trig_enable]
+                if triggers:
+                    self.trigger_tick = self.table.find_trigger(
+                        triggers, tick - self.start_tick)
+                    if self.trigger_tick is not None:
+                        self.trigger_tick += self.start_tick
+        self._check_frame_complete()
+    def read(self, offset):
+        offset &= 0x0f
+        if offset in (0, 1):
+            return ((self.have_frame << 3) | (self.force_trigger << 2)
+                    | (self.enable_trigger << 1) | self.active)
+        if offset in (2, 3):
+            return get_reg_byte(self.frame_preface, offset - 2)
+        if offset < 8:
+            return get_reg_byte(self.frame_size, offset - 4)
+        if offset < 12:
+            return get_reg_byte(self.reg_fifo_position, offset - 8)
+        return get_reg_byte(self.frame_count, offset - 12)
+    def write(self, offset, val):
+        offset &= 0x0f
+        tick = self.sim.get_tick()
+        self.update(tick)
+        if offset == 0:
+            self._set_status(val, tick)
+        elif offset in (2, 3) and not self.active:
+            preface = set_reg_byte(self.frame_preface, offset - 2, val)
+            self.frame_preface = preface & QUEUE_ADDR_MASK
+        elif offset in (4, 5, 6, 7) and not self.active:
+            self.frame_size = set_reg_byte(self.frame_size, offset - 4, val)
+    def pull_entries(self):
+        # Return data for the next SAMPLE message (or None)
+        if not self.have_frame or self.table is None:
+            return None
+        fifo_diff = self.push_counter - self.pull_counter
+        if not fifo_diff:
+            return None
+        if (self.active and fifo_diff < 48
+            and fifo_diff <= self.frame_count):
+            return None
+        count = min(fifo_diff, self.frame_count, MAX_MSG_ENTRIES)
+        index = self.pull_counter - self.start_push - 1
+        data = self.table.get_entries(index, count)
+        self.pull_counter += count
+        self.frame_count -= count
+        self._check_frame_complete()
+        return data
+
+
+######################################################################
+# Simulated device
+######################################################################
+
+# Encode a message from the fpga to the host
+def encode_message(msgid, seq, data):
+    count = len(data)
+    hdr = bytes(bytearray([0x60 | msgid, ((count & 0x03) << 6) | seq,
+                           count >> 2]))
+    crc = hcap.calc_crc16(hdr + data)
+    return hdr + data + bytes(bytearray([crc >> 8, crc & 0xff,
+                                         hcap.SCAN_CHAR]))
+
+class FPGASim:
+    def __init__(self, byte_rate=DEFAULT_BYTE_RATE, signals=None,
+                 fpga_freq=hcap.FPGA_FREQ, slow_freq=hcap.FPGA_SLOW_FREQ):
+        self.byte_rate = byte_rate
+        self.fpga_freq = fpga_freq
+        self.signals = signals or DEFAULT_SIGNALS
+        self.start_time = time.time()
+        # Reads may be issued from a different thread (see ThreadedReader)
+        self.lock = threading.Condition()
+        # Message handling
+        self.rx_buf = bytearray()
+        self.tx_buf = bytearray()
+        self.req_seq = self.send_seq = 0
+        self.need_scan = False
+        # Command handling (wbcmd.v) - one request is processed at a
+        # time and there is a single slot for a pending response
+        self.rx_tick = self.cmd_done_tick = 0
+        self.resp_slot = None
+        self.link_time = self.start_time
+        self.link_budget = 0.
+        self.stats = {"requests": 0, "bad_requests": 0, "seq_errors": 0,
+                      "dropped_requests": 0, "lost_responses": 0,
+                      "sample_msgs": 0, "sample_bytes": 0}
+        # Register modules
+        self.sq = SimSampleQueue(self)
+        self.channels = [SimADCChannel(self.sq) for ch in range(4)]
+        self.pllphase = SimPLLPhase()
+        self.i2c = SimI2C(slow_freq)
+        self.i2c.add_device(hcap.I2C_DAC_ADDR, SimMCP4728())
+        self.i2c.add_device(hcap.I2C_EXP1_ADDR, SimMCP23017())
+        # The "gain100" switches are off and the "imp10Mohm" switches on
+        self.i2c.add_device(hcap.I2C_EXP2_ADDR, SimMCP23017(0xf000))
+        mods = {"vers": SimVersion(), "adcspi": SimADCSPI(),
+                "i2c": self.i2c, "pp": self.pllphase, "sq": self.sq}
+        for ch in range(4):
+            mods["ch%d" % (ch,)] = self.channels[ch]
+        self.modules = {fpgaregs.FPGA_MODULES[name][0]: mod
+                        for name, mod in mods.items()}
+    def get_tick(self):
+        return int((time.time() - self.start_time) * self.fpga_freq)
+    def get_stats(self):
+        return ("Simulator: requests=%d bad=%d seq_errors=%d dropped=%d"
+                " lost_responses=%d sample_msgs=%d sample_bytes=%d\n"
+                % (self.stats["requests"], self.stats["bad_requests"],
+                   self.stats["seq_errors"], self.stats["dropped_requests"],
+                   self.stats["lost_responses"], self.stats["sample_msgs"],
+                   self.stats["sample_bytes"]))
+    # Message encoding
+    def _encode_message(self, msgid, data):
+        self.send_seq = (self.send_seq + 1) & 0x3f
+        self.tx_buf += encode_message(msgid, self.send_seq, data)
+    def _queue_response(self, data):
+        # A response generated while the slot is full is lost
+        if self.resp_slot is not None:
+            self.stats["lost_responses"] += 1
+            return
+        self.resp_slot = data
+    def _check_cmd_busy(self):
+        # Requests arrive one at a time at the link rate - a request
+        # that arrives while a command is in progress is ignored
+        tick = max(self.get_tick(), self.rx_tick)
+        self.rx_tick = tick
+        if self.byte_rate:
+            self.rx_tick += int(REQUEST_SIZE * self.fpga_freq
+                                / self.byte_rate)
+        if tick < self.cmd_done_tick:
+            return True
+        self.cmd_done_tick = tick + CMD_TICKS
+        return False
+    # Request parsing
+    def _check_request(self, req):
+        # Return the offset of the first invalid byte (or None if valid)
+        checks = [(0, req[0] == hcap.REQ_HDR), (1, not req[1] & 0xc0),
+                  (2, req[2] == 0x01), (3, not req[3] & 0x7f)]
+        if len(req) >= 9:
+            crc = hcap.calc_crc16(bytes(req[:7]))
+            checks.extend([(7, req[7] == crc >> 8), (8, req[8] == crc & 0xff)])
+        if len(req) >= 10:
+            checks.append((9, req[9] == hcap.SCAN_CHAR))
+        for offset, is_valid in checks:
+            if offset < len(req) and not is_valid:
+                return offset
+        return None
+    def _process_request(self, req):
+        self.stats["requests"] += 1
+        seq = req[1] & 0x3f
+        if seq != self.req_seq:
+            self.stats["seq_errors"] += 1
+            self._queue_response(bytes(bytearray([0x80 | self.req_seq, 0])))
+            return
+        if self._check_cmd_busy():
+            self.stats["dropped_requests"] += 1
+            return
+        self.req_seq = (self.req_seq + 1) & 0x3f
+        is_write = req[3] & 0x80
+        addr = req[4] | (req[5] << 8)
+        res = 0
+        mod = self.modules.get(addr >> 8)
+        if mod is not None:
+            if is_write:
+                mod.write(addr & 0xff, req[6])
+            else:
+                res = mod.read(addr & 0xff)
+        self._queue_response(bytes(bytearray([self.req_seq, res])))
+    def _process_requests(self):
+        buf = self.rx_buf
+        pos = 0
+        while pos < len(buf):
+            if self.need_scan:
+                # Discard data until the next message terminator
+                term = buf.find(hcap.SCAN_CHAR, pos)
+                if term < 0:
+                    pos = len(buf)
+                    break
+                pos = term + 1
+                self.need_scan = False
+                continue
+            req = buf[pos:pos+REQUEST_SIZE]
+            fail = self._check_request(req)
+            if fail is not None:
+                self.stats["bad_requests"] += 1
+                self.need_scan = True
+                pos += fail + 1
+                continue
+            if len(req) < REQUEST_SIZE:
+                break
+            pos += REQUEST_SIZE
+            self._process_request(req)
+        del buf[:pos]
+    # Serial device interface
+    def write(self, data):
+        with self.lock:
+            self.sq.update(self.get_tick())
+            self.rx_buf += data
+            self._process_requests()
+            # Wake up a reader waiting for a response
+            self.lock.notify_all()
+        return len(data)
+    def read(self, size):
+        with self.lock:
+            data = self._read(size)
+            if not data:
+                self.lock.wait(READ_TIMEOUT)
+                data = self._read(size)
+        return data
+    def _read(self, size):
+        self.sq.update(self.get_tick())
+        # Determine how much data the link could have transferred
+        curtime = time.time()
+        if self.byte_rate:
+            budget = (self.link_budget
+                      + (curtime - self.link_time) * self.byte_rate)
+            self.link_budget = min(budget, float(LINK_BUFFER_SIZE))
+            size = min(size, int(self.link_budget))
+        self.link_time = curtime
+        # Messages are sent one at a time - a pending response is sent
+        # once the current message completes
+        tx_buf = self.tx_buf
+        while len(tx_buf) < size:
+            if self.resp_slot is not None:
+                self._encode_message(0, self.resp_slot)
+                self.resp_slot = None
+                continue
+            data = self.sq.pull_entries()
+            if data is None:
+                break
+            self.stats["sample_msgs"] += 1
+            self.stats["sample_bytes"] += len(data)
+            self._encode_message(1, data)
+        data = bytes(tx_buf[:size])
+        del tx_buf[:len(data)]
+        if self.byte_rate:
+            self.link_budget -= len(data)
+        return data
+    def readinto(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+    def close(self):
+        pass
@@ -4,8 +4,8 @@
 # Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, optparse, time, io
-import fpgaregs
+import sys, os, optparse, time, io, json, binascii, threading, queue
+import fpgaregs, sqdecode, capfile
 
 class error(Exception):
     pass
@@ -18,30 +18,63 @@ class error(Exception):
 REQ_HDR=0x52
 SCAN_CHAR=0x7e
 
+# Table to reverse the order of bits in a byte
+BIT_REVERSE = bytes(bytearray([int("{:08b}".format(i)[::-1], 2)
+                               for i in range(256)]))
+
+def calc_crc16(data):
+    # The protocol uses a "reflected" crc16-ccitt (poly 0x8408, init
+    # 0xffff).  That is equivalent to the non-reflected crc_hqx() on
+    # bit reversed input, which allows the crc to be calculated in C.
+    crc = binascii.crc_hqx(data.translate(BIT_REVERSE), 0xffff)
+    return (BIT_REVERSE[crc & 0xff] << 8) | BIT_REVERSE[crc >> 8]
+
 def crc16_ccitt(buf, start, end):
-    crc = 0xffff
-    for pos in range(start, end):
-        data = buf[pos]
-        data ^= crc & 0xff
-        data ^= (data & 0x0f) << 4
-        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    crc = calc_crc16(bytes(bytearray(buf[start:end])))
     return [crc >> 8, crc & 0xff]
 
+# Size of receive buffer and of each read from the device
+RX_BUFFER_SIZE = 1024 * 1024
+READ_SIZE = 16 * 1024
+
+# Time without a response before a request is resent
+TX_RETRY_TIME = 0.250
+
 class SerialHandler:
     def __init__(self, modregs):
         self.modregs = modregs
-        self.ser = None
+        self.ser = self.ser_readinto = None
+        self.ser_threaded = False
         # Message parsing
         self.tx_seq = self.rx_seq = 0
         self.no_seq_warnings = False
         self.need_scan = False
         self.read_finish = 0.
-        self.data = bytearray()
+        self.rx_buf = bytearray(RX_BUFFER_SIZE)
+        self.rx_view = memoryview(self.rx_buf)
+        self.rx_start = self.rx_end = 0
+        self.rx_need = 6
+        self.read_size = READ_SIZE
         self.bulk_read_mode = False
         # Callbacks
         self.handlers = {}
         # Command tracking
         self.cmd = self.cmd_result = None
+        self.cmd_sent = 0.
+        # Register shadow cache (byte address to last known value)
+        self.reg_cache_enabled = False
+        self.reg_cache = {}
+        self.volatile_addrs = set()
+        self.reg_cache_hits = self.reg_cache_misses = 0
+        # Transaction tracing (None when disabled)
+        self.trace = None
+    def enable_trace(self):
+        self.trace = SerialTrace(self.modregs)
+    def get_trace(self):
+        return self.trace
+    def note_phase(self, phase):
+        if self.trace is not None:
+            self.trace.set_phase(phase)
     def register_stream(self, strm_id, callback):
         if callback is None:
             del self.handlers[strm_id]
@@ -49,6 +82,8 @@ class SerialHandler:
         self.handlers[strm_id] = callback
     def set_bulk_mode(self, bulk_read_mode):
         self.bulk_read_mode = bulk_read_mode
+    def set_read_size(self, read_size):
+        self.read_size = max(1, min(RX_BUFFER_SIZE // 2, read_size))
     def _warn(self, msg):
         sys.stdout.write("WARN: %s\n" % (msg,))
     def _default_stream(self, msg):
@@ -58,86 +93,111 @@ class SerialHandler:
     def clear(self):
         self._flush_connection()
         self.cmd = self.cmd_result = None
-    def read_data(self, read_finish):
-        self.read_finish = read_finish
-        bulk_read_mode = self.bulk_read_mode
-        reads = []
-        reads_pos = 0
-        data = self.data
-        dpos = 0
-        need_bytes = 6
+    def _read_into(self, view, read_finish):
+        if self.ser_threaded:
+            return self.ser.readinto(view, read_finish)
+        if self.ser_readinto is not None:
+            return self.ser_readinto(view)
+        d = self.ser.read(len(view))
+        view[:len(d)] = d
+        return len(d)
+    def _fill_rx_buffer(self):
+        # Move any partial message to the start of the buffer
+        if self.rx_start:
+            remaining = self.rx_end - self.rx_start
+            if remaining:
+                rx_buf = self.rx_buf
+                rx_buf[:remaining] = rx_buf[self.rx_start:self.rx_end]
+            self.rx_start = 0
+            self.rx_end = remaining
+        # Read data
+        read_size = self.read_size
+        read_finish = self.read_finish
+        while RX_BUFFER_SIZE - self.rx_end >= read_size:
+            rx_end = self.rx_end
+            count = self._read_into(self.rx_view[rx_end:rx_end + read_size],
+                                    read_finish)
+            if not count:
+                break
+            self.rx_end = rx_end + count
+            if not self.bulk_read_mode:
+                break
+            # Only wait for the first read
+            read_finish = 0.
+    def _parse_messages(self):
+        # Process all complete messages in the receive buffer
+        buf = self.rx_buf
+        view = self.rx_view
+        trace = self.trace
+        need_bytes = self.rx_need
         while 1:
-            if len(data) - dpos < need_bytes:
-                if len(reads) > reads_pos:
-                    data.extend(reads[reads_pos])
-                    reads_pos += 1
-                    continue
-                if reads_pos:
-                    reads[:] = []
-                    reads_pos = 0
-                if dpos:
-                    data[:dpos] = []
-                    dpos = 0
-                curtime = time.time()
-                if curtime >= self.read_finish:
-                    return
-                # Read data
-                retry_read = False
-                while 1:
-                    d = self.ser.read(16 * 1024)
-                    if d:
-                        reads.append(d)
-                        if not self.bulk_read_mode:
-                            break
-                        retry_read = True
-                        continue
-                    if not retry_read:
-                        break
-                    retry_read = False
-                continue
+            dpos = self.rx_start
+            avail = self.rx_end - dpos
+            if avail < need_bytes:
+                self.rx_need = need_bytes
+                return
             if self.need_scan:
-                drop = len(data)
-                sc = data.find(SCAN_CHAR)
+                drop = avail
+                sc = buf.find(SCAN_CHAR, dpos, self.rx_end)
                 if sc >= 0:
-                    drop = sc + 1
+                    drop = sc + 1 - dpos
                     self.need_scan = False
                 self._warn("Discard %d bytes" % (drop,))
-                dpos += drop
+                if trace is not None:
+                    trace.note_discard(drop)
+                self.rx_start = dpos + drop
                 continue
-            msg_header = data[dpos]
-            msg_lenseq = data[dpos+1] | (data[dpos+2] << 8)
+            msg_header = buf[dpos]
+            msg_lenseq = buf[dpos+1] | (buf[dpos+2] << 8)
             msg_datalen = msg_lenseq >> 6
             need_bytes = msg_datalen + 6
             if msg_header & 0xf0 == 0x60:
-                if len(data) - dpos < need_bytes:
+                if avail < need_bytes:
                     # Need more data
                     continue
-                msg_crc = list(data[dpos+msg_datalen+3:dpos+msg_datalen+5])
+                crc_pos = dpos + msg_datalen + 3
+                msg_crc = (buf[crc_pos] << 8) | buf[crc_pos + 1]
                 msg_seq = msg_lenseq & 0x3f
-                msg_term = data[dpos+msg_datalen+5]
+                msg_term = buf[crc_pos + 2]
                 if (msg_term == SCAN_CHAR
-                    and crc16_ccitt(data, dpos, dpos+msg_datalen+3) == msg_crc):
+                    and calc_crc16(view[dpos:crc_pos].tobytes()) == msg_crc):
                     # Got valid response
                     if msg_seq != (self.rx_seq + 1) & 0x3f:
                         if not self.no_seq_warnings:
                             self._warn("Receive sequence mismatch (%d vs %d)"
                                        % (msg_seq, self.rx_seq))
                     self.rx_seq = msg_seq
-                    msg_data = data[dpos+3:dpos+msg_datalen+3]
-                    dpos += need_bytes
+                    self.rx_start = dpos + need_bytes
                     need_bytes = 6
-                    # Process data in callback
+                    if trace is not None:
+                        trace.note_stream(msg_header, msg_datalen)
+                    # Process data in callback (msg_data is only valid
+                    # for the duration of the callback)
                     hdlr = self.handlers.get(msg_header, self._default_stream)
-                    hdlr(msg_data)
+                    hdlr(view[dpos+3:crc_pos])
                     continue
             # Invalid data - rescan
             need_bytes = 6
             self.need_scan = True
+    def read_data(self, read_finish):
+        self.read_finish = read_finish
+        while 1:
+            self._parse_messages()
+            if time.time() >= self.read_finish:
+                return
+            self._fill_rx_buffer()
     def _build_message(self, tx_seq, is_write, addr, val):
         msg = [REQ_HDR, tx_seq & 0x3f, 0x01,
                is_write, addr & 0xff, (addr >> 8) & 0xff, val & 0xff]
         msg.extend(crc16_ccitt(msg, 0, len(msg)) + [SCAN_CHAR])
         return bytes(bytearray(msg))
+    def _send_cmd(self, is_resend=False):
+        msg = self._build_message(*self.cmd)
+        self.ser.write(msg)
+        #sys.stdout.write("raw write: %s\n" % (repr(msg),))
+        if self.trace is not None:
+            self.trace.note_request(is_resend)
+            self.cmd_sent = time.time()
     def _handle_response(self, msgdata):
         # Got response to request
         if len(msgdata) != 2:
@@ -156,9 +216,10 @@ class SerialHandler:
             if not self.no_seq_warnings:
                 self._warn("Send sequence mismatch (seq %d vs %d)"
                            % (self.tx_seq, self.cmd[0]))
+            if self.trace is not None:
+                self.trace.note_seq_error()
             self.cmd = (self.tx_seq,) + self.cmd[1:]
-            msg = self._build_message(*self.cmd)
-            self.ser.write(msg)
+            self._send_cmd(is_resend=True)
             return
         if self.tx_seq != (self.cmd[0] + 1) & 0x3f:
             if not self.no_seq_warnings:
@@ -166,57 +227,151 @@ class SerialHandler:
                            % (self.tx_seq, self.cmd[0]))
             return
         # A valid response
+        if self.trace is not None:
+            self.trace.note_response(self.cmd[2],
+                                     time.time() - self.cmd_sent)
         self.cmd_result = res
         self.cmd = None
         self.read_finish = 0.
-    def _tx_message(self, is_write, addr, val):
+    def _begin_cmd(self, is_write, addr, val):
         if self.cmd is not None:
             raise error("Can't send command while in command")
         self.cmd = (self.tx_seq, is_write, addr, val)
-        msg = self._build_message(*self.cmd)
-        self.ser.write(msg)
-        #sys.stdout.write("raw write: %s\n" % (repr(msg),))
-        start_time = time.time()
-        retry_time = start_time + 0.250
+        self._send_cmd()
+        return time.time() + TX_RETRY_TIME
+    def _retry_cmd(self):
+        self._warn("Timeout in message handler. Retrying.")
+        if self.trace is not None:
+            self.trace.note_timeout()
+        self._flush_connection()
+        self._send_cmd(is_resend=True)
+        return time.time() + TX_RETRY_TIME
+    def _tx_message(self, is_write, addr, val):
+        retry_time = self._begin_cmd(is_write, addr, val)
         while 1:
             self.read_data(retry_time)
             if self.cmd is None:
                 return self.cmd_result
-            self._warn("Timeout in message handler. Retrying.")
-            self._flush_connection()
-            self.ser.write(msg)
-            curtime = time.time()
-            retry_time = curtime + 0.250
-    def write_reg(self, modname, regname, val):
-        #sys.stdout.write("Send: write 0x%04x of 0x%04x\n" % (addr, val))
+            retry_time = self._retry_cmd()
+    def _tx_messages(self, cmds):
+        # Send a list of (is_write, addr, val) requests and return the
+        # list of response values.  The fpga discards requests that
+        # arrive while it is busy (and has a single response slot), so
+        # each request is sent after the response to the previous one.
+        return [self._tx_message(*cmd) for cmd in cmds]
+    def _lookup_reg(self, modname, regname):
         modaddr, regs = self.modregs[modname]
         regaddr, regsize = regs[regname]
-        addr = (modaddr << 8) | regaddr
-        if regsize == 4:
-            self._tx_message(0x80, addr, val & 0xff)
-            self._tx_message(0x80, addr + 1, (val >> 8) & 0xff)
-            self._tx_message(0x80, addr + 2, (val >> 16) & 0xff)
-            self._tx_message(0x80, addr + 3, (val >> 24) & 0xff)
-        elif regsize == 2:
-            self._tx_message(0x80, addr, val & 0xff)
-            self._tx_message(0x80, addr + 1, (val >> 8) & 0xff)
+        return (modaddr << 8) | regaddr, regsize
+    def set_reg_cache(self, enabled):
+        self.reg_cache_enabled = enabled
+        self.reg_cache.clear()
+    def reset_reg_cache(self):
+        self.reg_cache.clear()
+    def mark_volatile(self, modname, regname):
+        addr, regsize = self._lookup_reg(modname, regname)
+        for i in range(regsize):
+            self.volatile_addrs.add(addr + i)
+            self.reg_cache.pop(addr + i, None)
+    def get_reg_cache_stats(self):
+        return ("Register cache: %d hits %d misses\n"
+                % (self.reg_cache_hits, self.reg_cache_misses))
+    def _tx_cached(self, cmds):
+        # Send requests, but update the register cache as well
+        try:
+            return self._tx_messages(cmds)
+        except:
+            # Unknown which requests completed
+            self.reg_cache.clear()
+            raise
+    def _build_cmds(self, accesses):
+        # Convert a list of (modname, regname, val) register accesses
+        # ('val' is None for reads) into a list of byte requests
+        cmds = []
+        sizes = []
+        for modname, regname, val in accesses:
+            addr, regsize = self._lookup_reg(modname, regname)
+            if val is None:
+                cmds.extend([(0x00, addr + i, 0x00) for i in range(regsize)])
+            else:
+                cmds.extend([(0x80, addr + i, (val >> (i * 8)) & 0xff)
+                             for i in range(regsize)])
+            sizes.append((regsize, val is None))
+        return cmds, sizes
+    def _combine_results(self, res, sizes):
+        # Convert byte responses into register values (None for writes)
+        vals = []
+        pos = 0
+        for regsize, is_read in sizes:
+            if is_read:
+                vals.append(sum([res[pos + i] << (i * 8)
+                                 for i in range(regsize)]))
+            else:
+                vals.append(None)
+            pos += regsize
+        return vals
+    def write_regs(self, writes):
+        # Write a list of (modname, regname, val) in order
+        cmds, sizes = self._build_cmds(writes)
+        if not self.reg_cache_enabled:
+            self._tx_messages(cmds)
+            return
+        # Skip writes that would not change a (cached) register
+        cache = self.reg_cache
+        volatile_addrs = self.volatile_addrs
+        send_cmds = []
+        for cmd in cmds:
+            is_write, addr, val = cmd
+            if addr in volatile_addrs:
+                send_cmds.append(cmd)
+            elif cache.get(addr) == val:
+                self.reg_cache_hits += 1
+            else:
+                self.reg_cache_misses += 1
+                cache[addr] = val
+                send_cmds.append(cmd)
+        if send_cmds:
+            self._tx_cached(send_cmds)
+    def read_regs(self, reads):
+        # Read a list of (modname, regname) in order
+        cmds, sizes = self._build_cmds([(modname, regname, None)
+                                        for modname, regname in reads])
+        if not self.reg_cache_enabled:
+            res = self._tx_messages(cmds)
         else:
-            self._tx_message(0x80, addr, val & 0xff)
-    def read_reg(self, modname, regname):
-        #sys.stdout.write("Send: read 0x%04x\n" % (addr,))
-        modaddr, regs = self.modregs[modname]
-        regaddr, regsize = regs[regname]
-        addr = (modaddr << 8) | regaddr
-        if regsize == 4:
-            return (self._tx_message(0x00, addr, 0x00)
-                    | (self._tx_message(0x00, addr + 1, 0x00) << 8)
-                    | (self._tx_message(0x00, addr + 2, 0x00) << 16)
-                    | (self._tx_message(0x00, addr + 3, 0x00) << 24))
-        elif regsize == 2:
-            return (self._tx_message(0x00, addr, 0x00)
-                    | (self._tx_message(0x00, addr + 1, 0x00) << 8))
+            # Only query registers not found in the cache
+            cache = self.reg_cache
+            volatile_addrs = self.volatile_addrs
+            res = [cache.get(addr) if addr not in volatile_addrs else None
+                   for is_write, addr, val in cmds]
+            send_cmds = [cmd for cmd, v in zip(cmds, res) if v is None]
+            self.reg_cache_hits += len(cmds) - len(send_cmds)
+            if send_cmds:
+                self.reg_cache_misses += len(send_cmds)
+                send_res = iter(self._tx_cached(send_cmds))
+                for i, (is_write, addr, val) in enumerate(cmds):
+                    if res[i] is None:
+                        res[i] = next(send_res)
+                        if addr not in volatile_addrs:
+                            cache[addr] = res[i]
+        return self._combine_results(res, sizes)
+    def access_regs(self, accesses):
+        # Send a list of (modname, regname, val) requests in order - a
+        # 'val' of None reads the register (results are returned in
+        # order, with None for each write)
+        cmds, sizes = self._build_cmds(accesses)
+        if not self.reg_cache_enabled:
+            res = self._tx_messages(cmds)
         else:
-            return self._tx_message(0x00, addr, 0x00)
+            res = self._tx_cached(cmds)
+            for is_write, addr, val in cmds:
+                if is_write and addr not in self.volatile_addrs:
+                    self.reg_cache[addr] = val
+        return self._combine_results(res, sizes)
+    def write_reg(self, modname, regname, val):
+        self.write_regs([(modname, regname, val)])
+    def read_reg(self, modname, regname):
+        return self.read_regs([(modname, regname)])[0]
     def dump_registers(self, modname=None):
         if modname is None:
             all_mods = self.modregs.items()
@@ -225,13 +380,16 @@ class SerialHandler:
                 self.dump_registers(modname)
             return
         adr, regs = self.modregs[modname]
-        regs = [(radr, rn) for rn, (radr, rs) in regs.items()]
-        for radr, regname in sorted(regs):
-            v = self.read_reg(modname, regname)
+        regs = sorted([(radr, rn) for rn, (radr, rs) in regs.items()])
+        vals = self.read_regs([(modname, regname) for radr, regname in regs])
+        for (radr, regname), v in zip(regs, vals):
             sys.stdout.write("%s: %s: 0x%02x\n" % (modname, regname, v))
     def setup(self, ser):
         self.ser = ser
+        self.ser_readinto = getattr(ser, "readinto", None)
+        self.ser_threaded = isinstance(ser, ThreadedReader)
         self.register_stream(0x60, self._handle_response)
+        self.reset_reg_cache()
         # Verify connection and obtain initial sequence numbers
         self._flush_connection()
         self.no_seq_warnings = True
@@ -241,6 +399,189 @@ class SerialHandler:
                          % (vers >> 16, (vers >> 8) & 0xff, vers & 0xff))
 
 
+######################################################################
+# Transaction tracing
+######################################################################
+
+# Report latency in buckets of powers of two microseconds
+def _latency_bucket(latency):
+    return int(latency * 1000000.).bit_length()
+
+# Statistics on register requests and received messages
+class SerialTrace:
+    def __init__(self, modregs):
+        # Map of byte address to register name
+        self.addr_names = {}
+        for modname, (modaddr, regs) in modregs.items():
+            for regname, (regaddr, regsize) in regs.items():
+                for i in range(regsize):
+                    addr = (modaddr << 8) | (regaddr + i)
+                    self.addr_names[addr] = "%s.%s" % (modname, regname)
+        # Register statistics (name: [count, total_latency, max_latency])
+        self.reg_stats = {}
+        self.latency_hist = {}
+        # Error statistics
+        self.timeouts = self.seq_errors = self.resends = 0
+        self.discards = self.discard_bytes = 0
+        # Received messages (msgid: [count, bytes])
+        self.stream_stats = {}
+        # Phases (list of [name, start_time, elapsed, requests, resends])
+        self.phases = []
+        self.set_phase("startup")
+    def set_phase(self, name):
+        curtime = time.time()
+        if self.phases:
+            last = self.phases[-1]
+            last[2] = curtime - last[1]
+        self.phases.append([name, curtime, 0., 0, 0])
+    def note_request(self, is_resend):
+        phase = self.phases[-1]
+        phase[3] += 1
+        if is_resend:
+            phase[4] += 1
+            self.resends += 1
+    def note_response(self, addr, latency):
+        name = self.addr_names.get(addr, "0x%04x" % (addr,))
+        stats = self.reg_stats.get(name)
+        if stats is None:
+            stats = self.reg_stats[name] = [0, 0., 0.]
+        stats[0] += 1
+        stats[1] += latency
+        stats[2] = max(stats[2], latency)
+        bucket = _latency_bucket(latency)
+        self.latency_hist[bucket] = self.latency_hist.get(bucket, 0) + 1
+    def note_timeout(self):
+        self.timeouts += 1
+    def note_seq_error(self):
+        self.seq_errors += 1
+    def note_discard(self, count):
+        self.discards += 1
+        self.discard_bytes += count
+    def note_stream(self, msgid, count):
+        stats = self.stream_stats.get(msgid)
+        if stats is None:
+            stats = self.stream_stats[msgid] = [0, 0]
+        stats[0] += 1
+        stats[1] += count
+    def get_data(self):
+        phases = [list(p) for p in self.phases]
+        phases[-1][2] = time.time() - phases[-1][1]
+        return {
+            'timeouts': self.timeouts, 'seq_errors': self.seq_errors,
+            'resends': self.resends, 'discards': self.discards,
+            'discard_bytes': self.discard_bytes,
+            'streams': {"0x%02x" % (msgid,): {'messages': c, 'bytes': b}
+                        for msgid, (c, b) in self.stream_stats.items()},
+            'phases': [{'name': n, 'time': e, 'requests': r, 'resends': rs}
+                       for n, st, e, r, rs in phases],
+            'registers': {name: {'count': c, 'avg_latency': t / c,
+                                 'max_latency': m}
+                          for name, (c, t, m) in self.reg_stats.items()},
+            'latency_histogram': [[1 << b, c] for b, c
+                                  in sorted(self.latency_hist.items())],
+        }
+    def get_report(self):
+        data = self.get_data()
+        out = ["Trace: timeouts=%d seq_errors=%d resends=%d"
+               " discards=%d (%d bytes)"
+               % (data['timeouts'], data['seq_errors'], data['resends'],
+                  data['discards'], data['discard_bytes'])]
+        for msgid, info in sorted(data['streams'].items()):
+            out.append("  stream %s: messages=%d bytes=%d"
+                       % (msgid, info['messages'], info['bytes']))
+        for info in data['phases']:
+            out.append("  phase %s: time=%.6fs requests=%d resends=%d"
+                       % (info['name'], info['time'], info['requests'],
+                          info['resends']))
+        for name, info in sorted(data['registers'].items()):
+            out.append("  register %s: count=%d avg=%.1fus max=%.1fus"
+                       % (name, info['count'], info['avg_latency'] * 1000000.,
+                          info['max_latency'] * 1000000.))
+        hist = data['latency_histogram']
+        total = max(1, sum([count for max_us, count in hist]))
+        for max_us, count in hist:
+            out.append("  latency <%8dus: %7d %s"
+                       % (max_us, count,
+                          "#" * ((count * 50 + total - 1) // total)))
+        return "\n".join(out) + "\n"
+
+
+######################################################################
+# Threaded reader
+######################################################################
+
+# Number of pending reads that may be queued by the reader thread
+READER_QUEUE_SIZE = 1024
+
+# Wrapper around a serial device that reads from it in a background thread
+class ThreadedReader:
+    def __init__(self, ser, read_size=READ_SIZE):
+        self.ser = ser
+        self.write = ser.write
+        self.read_size = read_size
+        self.queue = queue.Queue(READER_QUEUE_SIZE)
+        self.pending = b""
+        self.pending_pos = 0
+        # Statistics
+        self.bytes_read = self.read_count = 0
+        self.max_depth = self.stall_count = 0
+        # Start reader thread
+        self.is_active = True
+        self.thread = threading.Thread(target=self._reader)
+        self.thread.daemon = True
+        self.thread.start()
+    def _reader(self):
+        ser_read = self.ser.read
+        q = self.queue
+        while self.is_active:
+            d = ser_read(self.read_size)
+            if not d:
+                continue
+            self.bytes_read += len(d)
+            self.read_count += 1
+            depth = q.qsize() + 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+            try:
+                q.put_nowait(d)
+            except queue.Full:
+                # Host is not processing data as fast as it arrives
+                self.stall_count += 1
+                q.put(d)
+    def readinto(self, view, read_finish=0.):
+        # Wait (until the given time) for data from the reader thread
+        if self.pending_pos >= len(self.pending):
+            try:
+                self.pending = self.queue.get(
+                    timeout=max(0., read_finish - time.time()))
+            except queue.Empty:
+                return 0
+            self.pending_pos = 0
+        pos = self.pending_pos
+        count = min(len(view), len(self.pending) - pos)
+        view[:count] = self.pending[pos:pos + count]
+        self.pending_pos = pos + count
+        return count
+    def read(self, size):
+        d = bytearray(size)
+        count = self.readinto(memoryview(d))
+        return bytes(d[:count])
+    def get_stats(self):
+        return ("Reader thread: bytes=%d reads=%d queue_depth=%d"
+                " max_depth=%d/%d stalls=%d\n"
+                % (self.bytes_read, self.read_count, self.queue.qsize(),
+                   self.max_depth, READER_QUEUE_SIZE, self.stall_count))
+    def close(self):
+        self.is_active = False
+        # Wake up reader if it is blocked on a full queue
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(0.010)
+
+
 ######################################################################
 # I2C helper
 ######################################################################
@@ -248,57 +589,122 @@ class SerialHandler:
 class i2c_error(Exception):
     pass
 
+I2C_FREQ = 100000
+# Bus clocks needed to transfer an i2c byte (8 data bits and an ack)
+I2C_BYTE_CLOCKS = 9
+# Number of status polls per byte transfer time
+I2C_POLLS_PER_BYTE = 4
+# Maximum time to wait for an i2c byte to complete
+I2C_BYTE_TIMEOUT = 0.050
+
+I2C_STA, I2C_STO, I2C_RD, I2C_WR, I2C_NACK = 1<<7, 1<<6, 1<<5, 1<<4, 1<<3
+I2C_TIP = 1<<1
+
 class I2CHelper:
     def __init__(self, serialhdl):
         self.read_reg = serialhdl.read_reg
         self.write_reg = serialhdl.write_reg
-    def _send_i2c_byte(self, cmdflags, data=None):
-        if not (cmdflags & (1<<5)):
-            self.write_reg("i2c", "txr", data)
-        self.write_reg("i2c", "cr", cmdflags)
-        while 1:
-            res = self.read_reg("i2c", "sr")
-            if not (res & (1<<1)):
-                # Complete
-                break
-        expected_res = (cmdflags & (1<<6)) ^ (1<<6)
-        if (res & ~(0x01)) != expected_res:
+        self.access_regs = serialhdl.access_regs
+        self.poll_delay = I2C_BYTE_CLOCKS / (I2C_FREQ * I2C_POLLS_PER_BYTE)
+        # Statistics
+        self.trans_count = self.byte_count = self.poll_count = 0
+        self.total_time = self.max_time = 0.
+    def _check_status(self, cmdflags, sts):
+        expected_res = (cmdflags & I2C_STO) ^ I2C_STO
+        if (sts & ~(0x01)) != expected_res:
             if expected_res:
-                self.write_reg("i2c", "cr", 1<<6)
+                self.write_reg("i2c", "cr", I2C_STO)
             raise i2c_error("i2c send fault")
-    def _try_send_i2c(self, addr, write, read_count=0):
+    def _wait_i2c_byte(self):
+        # Paced (and bounded) poll of the i2c status
+        end_time = time.time() + I2C_BYTE_TIMEOUT
+        while 1:
+            time.sleep(self.poll_delay)
+            sts = self.read_reg("i2c", "sr")
+            self.poll_count += 1
+            if not (sts & I2C_TIP):
+                return sts
+            if time.time() > end_time:
+                self.write_reg("i2c", "cr", I2C_STO)
+                raise i2c_error("i2c byte timeout")
+    def _send_i2c_byte(self, cmdflags, data=None):
+        # Send a byte and read its status (the round trips of the
+        # requests usually cover the transfer time)
+        is_read = cmdflags & I2C_RD
+        accesses = []
+        if not is_read:
+            accesses.append(("i2c", "txr", data))
+        accesses.append(("i2c", "cr", cmdflags))
+        accesses.append(("i2c", "sr", None))
+        if is_read:
+            accesses.append(("i2c", "rxr", None))
+        res = self.access_regs(accesses)
+        if is_read:
+            sts, rx = res[-2:]
+        else:
+            sts, rx = res[-1], None
+        if sts & I2C_TIP:
+            sts = self._wait_i2c_byte()
+            if is_read:
+                rx = self.read_reg("i2c", "rxr")
+        self._check_status(cmdflags, sts)
+        return rx
+    def _build_i2c_bytes(self, addr, write, read_count):
+        # Return a list of (cmdflags, data) for an i2c transaction
         addrwr = addr << 1
+        ibytes = []
         if write:
-            self._send_i2c_byte((1<<7) | (1<<4), addrwr)
+            ibytes.append((I2C_STA | I2C_WR, addrwr))
             for i, b in enumerate(write):
-                cmdflags = 1<<4
+                cmdflags = I2C_WR
                 if not read_count and i == len(write) - 1:
-                    cmdflags |= 1<<6
-                self._send_i2c_byte(cmdflags, b)
-        res = []
+                    cmdflags |= I2C_STO
+                ibytes.append((cmdflags, b))
         if read_count:
-            self._send_i2c_byte((1<<7) | (1<<4), addrwr | 1)
+            ibytes.append((I2C_STA | I2C_WR, addrwr | 1))
             for i in range(read_count):
-                cmdflags = 1<<5
+                cmdflags = I2C_RD
                 if i == read_count - 1:
-                    cmdflags |= (1<<6) | (1<<3)
-                self._send_i2c_byte(cmdflags)
-                res.append(self.read_reg("i2c", "rxr"))
+                    cmdflags |= I2C_STO | I2C_NACK
+                ibytes.append((cmdflags, None))
+        return ibytes
+    def _try_send_i2c(self, addr, write, read_count=0):
+        res = []
+        for cmdflags, data in self._build_i2c_bytes(addr, write, read_count):
+            rx = self._send_i2c_byte(cmdflags, data)
+            if cmdflags & I2C_RD:
+                res.append(rx)
         #sys.stdout.write("i2c 0x%02x %s is %s\n" % (addr, write, res))
         return res
     def send_i2c(self, addr, write, read_count=0):
+        start_time = time.time()
         while 1:
             try:
-                return self._try_send_i2c(addr, write, read_count)
+                res = self._try_send_i2c(addr, write, read_count)
+                break
             except i2c_error as e:
                 sys.stdout.write("i2c send fail to addr %02x\n" % (addr,))
                 time.sleep(0.001)
+        elapsed = time.time() - start_time
+        self.trans_count += 1
+        self.byte_count += len(write) + read_count
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return res
+    def get_stats(self):
+        avg_time = self.total_time / max(1, self.trans_count)
+        return ("I2C: transactions=%d bytes=%d extra_polls=%d"
+                " avg=%.3fms max=%.3fms\n"
+                % (self.trans_count, self.byte_count, self.poll_count,
+                   avg_time * 1000., self.max_time * 1000.))
     def setup(self, fpga_freq):
-        i2c_freq = 100000
         self.write_reg("i2c", "ctr", 0x00)
-        isp = fpga_freq // (5 * i2c_freq) - 1
+        isp = fpga_freq // (5 * I2C_FREQ) - 1
         self.write_reg("i2c", "prer", isp)
         self.write_reg("i2c", "ctr", 0x80)
+        # Poll several times during the transfer time of a byte
+        bus_freq = fpga_freq / (5. * (isp + 1))
+        self.poll_delay = I2C_BYTE_CLOCKS / (bus_freq * I2C_POLLS_PER_BYTE)
 
 
 ######################################################################
@@ -313,14 +719,28 @@ class mcp23017:
         self.pin_names = pin_names
         self.reg_iodir = 0xffff
         self.reg_gppu = self.reg_iolat = self.reg_gpio = 0
-    def update_pins(self):
-        addr = self.i2c_addr
-        iodir = self.reg_iodir
-        iolat = self.reg_iolat
-        gppu = self.reg_gppu
-        self.send_i2c(addr, [0x14, iolat & 0xff, iolat >> 8])
-        self.send_i2c(addr, [0x00, iodir & 0xff, iodir >> 8])
-        self.send_i2c(addr, [0x0c, gppu & 0xff, gppu >> 8])
+        # Last values sent to the chip (None if unknown)
+        self.sent_regs = {}
+    def _update_reg(self, reg, val):
+        # Only write the bytes of a register pair that have changed
+        last_val = self.sent_regs.get(reg)
+        if last_val == val:
+            return
+        data = [val & 0xff, val >> 8]
+        if last_val is not None:
+            if last_val & 0xff == val & 0xff:
+                reg += 1
+                data = data[1:]
+            elif last_val >> 8 == val >> 8:
+                data = data[:1]
+        self.send_i2c(self.i2c_addr, [reg] + data)
+        self.sent_regs[reg & ~1] = val
+    def update_pins(self, force=False):
+        if force:
+            self.sent_regs.clear()
+        self._update_reg(0x14, self.reg_iolat)
+        self._update_reg(0x00, self.reg_iodir)
+        self._update_reg(0x0c, self.reg_gppu)
     def read_pins(self):
         res = self.send_i2c(self.i2c_addr, [0x12], read_count=2)
         self.reg_gpio = res[0] | (res[1] << 8)
@@ -350,6 +770,8 @@ class mcp4728:
     def __init__(self, send_i2c, i2c_addr):
         self.send_i2c = send_i2c
         self.i2c_addr = i2c_addr
+        self.values = [0] * 4
+        self.sent_values = [None] * 4
     def _encode_volt(self, volt):
         volt = max(0., min(3.3, volt))
         if volt >= 2.0485:
@@ -362,11 +784,22 @@ class mcp4728:
     def calc_volt(self, volt):
         return self._decode_volt(self._encode_volt(volt))
     def set_dac(self, channel, volt):
-        value = self._encode_volt(volt)
-        #sys.stdout.write("dac %d %.4f 0x%03x\n" % (channel, volt, value))
-        self.send_i2c(self.i2c_addr,
-                      [0x40 | (channel << 1), ((value >> 8) & 0x1f) | 0x80,
-                       value & 0xff])
+        # The new value is sent on the next call to update_dacs()
+        self.values[channel] = self._encode_volt(volt)
+    def update_dacs(self, force=False):
+        if force:
+            self.sent_values = [None] * 4
+        # Send all changed channels using a single "multi-write" command
+        data = []
+        for channel, value in enumerate(self.values):
+            if value == self.sent_values[channel]:
+                continue
+            #sys.stdout.write("dac %d 0x%03x\n" % (channel, value))
+            data.extend([0x40 | (channel << 1), ((value >> 8) & 0x1f) | 0x80,
+                         value & 0xff])
+        if data:
+            self.send_i2c(self.i2c_addr, data)
+            self.sent_values = list(self.values)
 
 # max19506 SPI helper
 class Max19506spi:
@@ -423,11 +856,11 @@ class PLLPhase:
 # Sample Queue handling
 ######################################################################
 
-# Mapping of bit resolution to fpga control code
-DEPOSIT_TYPES = {
-    # num_bits: (measurements_per_sample, shift, code)
-    8: (9, 8, 0), 12: (6, 12, 1), 6: (12, 6, 2),
-}
+DEPOSIT_TYPES = sqdecode.DEPOSIT_TYPES
+BYTES_PER_SAMPLE = sqdecode.BYTES_PER_SAMPLE
+
+# Amount of buffered frame data that triggers a decode in stream mode
+STREAM_FLUSH_BYTES = 1024 * 1024
 
 class SQHelper:
     def __init__(self, serialhdl, fpga_freq):
@@ -435,6 +868,8 @@ class SQHelper:
         self.fpga_freq = fpga_freq
         self.read_reg = self.serialhdl.read_reg
         self.write_reg = self.serialhdl.write_reg
+        self.read_regs = self.serialhdl.read_regs
+        self.write_regs = self.serialhdl.write_regs
         # Frame config
         self.frame_preface = 0.000002
         self.frame_time = 0.100
@@ -447,9 +882,25 @@ class SQHelper:
         self.meas_base = 0
         self.do_meas_sum = True
         # Frame handling
-        self.frame_datas = []
+        self.stream_mode = False
+        self.frame_data = bytearray()
+        self.frame_bytes = self.line_num = 0
+        self.skip_bytes = None
+        self.decoder = self.writer = self.raw_store = None
+        self.expected_bytes = 0
         self.af_helpers = None
+        self.output_format = "csv"
         self.csvfilename = None
+        self.writer_class = None
+        self.envelope_points = 0
+        self.jobs = 1
+        # Segmented capture
+        self.segments = 1
+        self.segment_deadline = 0.
+        self.frame_prefix = 0
+        # Synchronized triggering of several devices
+        self.trigger_sync = None
+        self.trigger_time = 0.
     def setup_cmdline_options(self, opts):
         opts.add_option("-q", "--queryrate", type="string", default="125MHz",
                         help="Sample query rate")
@@ -461,6 +912,22 @@ class SQHelper:
                         help="Time prior to trigger to report")
         opts.add_option("--average", type="int", default=1,
                         help="Average measurements at lower query rates")
+        opts.add_option("--stream", action="store_true",
+                        help="Decode and write data while capturing")
+        opts.add_option("--segments", type="int", default=1,
+                        help="Number of triggered frames to capture"
+                        " (0 for no limit)")
+        opts.add_option("--segment-deadline", type="string", default=None,
+                        help="Do not start new frames after this time")
+        opts.add_option("--format", type="choice", default="csv",
+                        choices=sorted(capfile.FORMATS.keys()),
+                        help="Output file format (%s)"
+                        % (", ".join(sorted(capfile.FORMATS.keys())),))
+        opts.add_option("--jobs", type="int", default=1,
+                        help="Number of processes used to decode data")
+        opts.add_option("--envelope", type="int", default=0,
+                        help="Also write a min/max/mean summary with this"
+                        " number of lines")
     def _parse_hz(self, val):
         val = val.strip().lower()
         mult = 1000000.
@@ -481,6 +948,7 @@ class SQHelper:
         return float(val) * mult
     def note_cmdline_options(self, options):
         qrate = self._parse_hz(options.queryrate)
+        self.interleave = False
         if qrate == 250000000.:
             self.interleave = True
             qrate /= 2.
@@ -494,10 +962,36 @@ class SQHelper:
         self.channel_div = max(1, min(0x100, int(self.fpga_freq // qrate)))
         self.frame_time = self._parse_time(options.duration)
         self.preface_time = self._parse_time(options.preface)
+        self.stream_mode = not not options.stream
+        self.output_format = options.format
+        self.envelope_points = max(0, options.envelope)
+        self.jobs = max(1, options.jobs)
+        self.segments = max(0, options.segments)
+        self.segment_deadline = 0.
+        if options.segment_deadline is not None:
+            self.segment_deadline = self._parse_time(options.segment_deadline)
+        if not self.segments and not self.segment_deadline:
+            sys.stdout.write("Must specify --segments or --segment-deadline\n")
+            sys.exit(-1)
     def note_filename(self, csvfilename):
         self.csvfilename = csvfilename
+    def set_writer_class(self, writer_class):
+        # Override the output format (writer_class(filename, info))
+        self.writer_class = writer_class
+    def set_trigger_sync(self, trigger_sync):
+        # Callback invoked after arming (just prior to enabling the trigger)
+        self.trigger_sync = trigger_sync
+    def get_trigger_time(self):
+        return self.trigger_time
     def _note_frame_data(self, msgdata):
-        self.frame_datas.append(msgdata)
+        self.frame_bytes += len(msgdata)
+        if self.raw_store is not None:
+            self.raw_store.write_data(msgdata)
+            return
+        self.frame_data.extend(msgdata)
+        if (self.skip_bytes is not None
+            and len(self.frame_data) >= STREAM_FLUSH_BYTES):
+            self._flush_frame_data()
     def is_interleaving(self):
         return self.interleave
     def get_status(self):
@@ -507,103 +1001,96 @@ class SQHelper:
                    self.preface_time, self.frame_time,
                    self.do_meas_sum, self.meas_bits,
                    self.meas_mask, self.meas_base))
-    def _parse_frame_data(self, frame_slot):
-        # Handle multiple measurements in each sample queue entry
-        meas_per_sample, meas_shift, meas_code = DEPOSIT_TYPES[self.meas_bits]
-        meas_mask = self.meas_mask
-        meas_mult = 1.
-        if self.do_meas_sum:
-            meas_mult = 1. / self.channel_div
-        # Build map of measurement sample offsets for each active channel
-        BYTES_PER_SAMPLE = 9
-        interleave = self.interleave
-        cmap = []
-        hdr_desc = ["unused%d" % (ch,) for ch in range(4)]
-        num_channels = 0
+    def _get_capture_info(self):
+        channels = []
         for ch, ah in enumerate(self.af_helpers):
             if not ah.check_is_capturing():
                 continue
             base_v, adc_factor = ah.get_adc_base_factor()
-            offset = num_channels * BYTES_PER_SAMPLE
-            adc_factor *= meas_mult
-            for j in range(meas_per_sample):
-                mnum = meas_per_sample - 1 - j
-                shift = (j * meas_shift) % 8
-                byte_start = (j * meas_shift) // 8
-                offsets = [offset + (byte_start + k) % BYTES_PER_SAMPLE
-                           for k in range(3)]
-                cmap.append((ch, mnum, offsets, shift, base_v, adc_factor))
-            num_channels += 1
-            if not interleave or ch < 2:
-                hdr_desc[ch] = "ch%d" % (ch,)
-        # Skip unaligned reports at start and end of data
-        frame_datas = self.frame_datas
-        total_bytes = sum([len(fd) for fd in frame_datas])
-        sample_count = total_bytes // BYTES_PER_SAMPLE
+            channels.append((ch, base_v, adc_factor))
+        status = [self.get_status()]
+        status.extend([ah.get_status() for ah in self.af_helpers])
+        params = {
+            'fpga_freq': self.fpga_freq, 'channel_div': self.channel_div,
+            'interleave': self.interleave, 'do_meas_sum': self.do_meas_sum,
+            'meas_bits': self.meas_bits, 'meas_mask': self.meas_mask,
+            'meas_base': self.meas_base, 'preface_time': self.preface_time,
+            'frame_time': self.frame_time, 'frame_prefix': self.frame_prefix,
+            'channels': channels,
+            'status': status, 'start_time': time.asctime(),
+        }
+        return capfile.CaptureInfo(params)
+    def _start_frame(self, filename):
+        info = self._get_capture_info()
+        self.decoder = info.get_decoder()
+        self.frame_data = bytearray()
+        self.frame_bytes = self.line_num = 0
+        self.skip_bytes = None
+        self.raw_store = None
+        if self.writer_class is not None:
+            self.writer = self.writer_class(filename, info)
+        elif self.output_format == "raw" and not self.envelope_points:
+            # Sample queue data is stored directly as it arrives
+            self.writer = self.raw_store = capfile.RawWriter(
+                filename, info, self.expected_bytes)
+        else:
+            self.writer = capfile.create_writer(self.output_format, filename,
+                                                info, self.jobs)
+        if self.envelope_points:
+            envfile = capfile.get_envelope_filename(filename)
+            envelope = capfile.EnvelopeWriter(envfile, info,
+                                              self.envelope_points)
+            self.writer = capfile.MultiWriter([self.writer, envelope])
+    def _note_frame_slot(self, frame_slot):
+        # Skip unaligned reports at start of data
+        num_channels = self.decoder.num_channels
         skip_start = (num_channels - (frame_slot % num_channels)) % num_channels
-        sample_count -= skip_start
-        sample_count -= sample_count % num_channels
+        self.skip_bytes = skip_start * BYTES_PER_SAMPLE
+        if self.raw_store is not None:
+            self.raw_store.note_skip_start(skip_start)
+    def _count_lines(self, data_bytes):
+        lines = ((data_bytes // self.decoder.get_group_size())
+                 * self.decoder.get_meas_per_sample())
+        if self.interleave:
+            lines *= 2
+        return lines
+    def _flush_frame_data(self):
+        frame_data = self.frame_data
+        if self.skip_bytes:
+            drop = min(self.skip_bytes, len(frame_data))
+            del frame_data[:drop]
+            self.skip_bytes -= drop
+        decoder = self.decoder
+        group_size = decoder.get_group_size()
+        end_pos = len(frame_data) - len(frame_data) % group_size
+        if not end_pos:
+            return
+        # Decode data in blocks and write to file
+        block_size = capfile.DECODE_BLOCK_GROUPS * group_size
+        with memoryview(frame_data) as data:
+            for base_pos in range(0, end_pos, block_size):
+                block_end = min(base_pos + block_size, end_pos)
+                self.writer.write_data(data[base_pos:block_end])
+        self.line_num += self._count_lines(end_pos)
+        del frame_data[:end_pos]
+    def _finish_frame(self, frame_slot):
+        if self.skip_bytes is None:
+            self._note_frame_slot(frame_slot)
+        if self.raw_store is not None:
+            self.line_num = self._count_lines(
+                max(0, self.frame_bytes - self.skip_bytes))
+        self._flush_frame_data()
+        # Skip unaligned reports at end of data
+        self.frame_data = bytearray()
+        total_bytes = self.frame_bytes
         stime = float(self.channel_div) / self.fpga_freq
-        if interleave:
+        if self.interleave:
             stime /= 2.
-        total_sample_groups = sample_count // num_channels
-        total_lines = total_sample_groups * meas_per_sample
         sys.stdout.write("Total bytes %d (%d sample queue) %d lines (%.9fs)\n"
                          % (total_bytes, total_bytes//BYTES_PER_SAMPLE,
-                            total_lines, total_lines * stime))
-        # CSV file header
-        hdrs = ["; HSoft data capture '%s'" % (time.asctime(),)]
-        hdrs.append(";")
-        sts = self.get_status()
-        hdrs.extend([("; " + s).strip() for s in sts.split('\n')])
-        for ah in self.af_helpers:
-            sts = ah.get_status()
-            hdrs.extend([("; " + s).strip() for s in sts.split('\n')])
-        hdrs.append("time,%s" % (",".join(hdr_desc)))
-        hdrs.append("")
-        header = "\n".join(hdrs)
-        # Create file
-        csvf = io.open(self.csvfilename, "w")
-        csvf.write(header)
-        # Write data to file
-        frame_data = bytearray()
-        frames_pos = 0
-        line_data = [[0.] * 4 for i in range(meas_per_sample)]
-        line_num = sample_group_num = 0
-        base_pos = skip_start * BYTES_PER_SAMPLE
-        while sample_group_num < total_sample_groups:
-            # Check if need to extract more data
-            if len(frame_data) < base_pos + BYTES_PER_SAMPLE * num_channels:
-                if base_pos and len(frame_data) > base_pos:
-                    frame_data[:base_pos] = []
-                    base_pos = 0
-                frame_data.extend(frame_datas[frames_pos])
-                frames_pos += 1
-                continue
-            # Find measurements for this "group" of data
-            for ch, mnum, (off0, off1, off2), shift, base_v, adc_factor in cmap:
-                d = (frame_data[base_pos+off0]
-                     | (frame_data[base_pos+off1] << 8)
-                     | (frame_data[base_pos+off2] << 16))
-                m = (d >> shift) & meas_mask
-                v = base_v + m * adc_factor
-                line_data[mnum][ch] = v
-            sample_group_num += 1
-            base_pos += BYTES_PER_SAMPLE * num_channels
-            # Write line to csv file
-            if interleave:
-                for ld in line_data:
-                    csvf.write("%.9f,%.6f,%.6f,0,0\n%.9f,%.6f,%.6f,0,0\n"
-                               % (line_num*stime, ld[0], ld[1],
-                                  (line_num+1)*stime, ld[2], ld[3]))
-                    line_num += 2
-            else:
-                for ld in line_data:
-                    csvf.write("%.9f,%.6f,%.6f,%.6f,%.6f\n"
-                               % (line_num*stime, ld[0], ld[1], ld[2], ld[3]))
-                    line_num += 1
-        csvf.write("; End of capture (%d data lines)\n" % (line_num,))
-        csvf.close()
+                            self.line_num, self.line_num * stime))
+        self.writer.close()
+        self.writer = None
     def _calc_meas_mask(self):
         meas_bits = self.meas_bits
         if self.channel_div == 1:
@@ -620,47 +1107,65 @@ class SQHelper:
             meas_base = 1 << (need_shift - 1)
         self.meas_mask = meas_mask
         self.meas_base = meas_base
-    def capture_frame(self, af_helpers, force_trigger):
+    def _configure_capture(self, af_helpers):
+        self.serialhdl.note_phase("capture_config")
         self.af_helpers = af_helpers
         self._calc_meas_mask()
         sys.stdout.write(self.get_status())
         # Enable fifo
         meas_per_sample, meas_shift, meas_code = DEPOSIT_TYPES[self.meas_bits]
         num_channels = 0
+        ch_writes = []
         for ch in range(4):
             is_capturing = self.af_helpers[ch].check_is_capturing()
             num_channels += is_capturing
             chname = "ch%d" % (ch,)
-            self.write_reg(chname, "status", 0x00)
-            self.write_reg(chname, "acc_cnt", self.channel_div - 1)
-            self.write_reg(chname, "sum_mask", self.meas_mask)
-            self.write_reg(chname, "initial_sum", self.meas_base)
-            self.write_reg(chname, "status",
-                           (is_capturing | (self.do_meas_sum << 1)
-                            | (meas_code << 4)))
+            ch_writes.extend([
+                (chname, "status", 0x00),
+                (chname, "acc_cnt", self.channel_div - 1),
+                (chname, "sum_mask", self.meas_mask),
+                (chname, "initial_sum", self.meas_base),
+                (chname, "status", (is_capturing | (self.do_meas_sum << 1)
+                                    | (meas_code << 4)))])
         qrate = (self.fpga_freq * num_channels
                  / (meas_per_sample * self.channel_div))
         frame_size = max(16, min(0xffffffff, int(self.frame_time * qrate)))
-        self.write_reg("sq", "frame_size", frame_size)
         frame_prefix = max(8, min(0x1000, int(self.preface_time * qrate)))
-        self.write_reg("sq", "frame_preface", frame_prefix)
+        self.write_regs(ch_writes + [("sq", "frame_size", frame_size),
+                                     ("sq", "frame_preface", frame_prefix)])
+        self.frame_prefix = frame_prefix
+        self.expected_bytes = (frame_size + frame_prefix) * BYTES_PER_SAMPLE
+    def _capture_segment(self, filename, force_trigger):
+        frame_prefix = self.frame_prefix
         # Start sampling
+        self.serialhdl.note_phase("capture_arm")
         sys.stdout.write(" START SAMPLING\n")
         self.write_reg("sq", "status", 0x81)
         start_pos = self.read_reg("sq", "reg_fifo_position")
         # Query fifo data
+        self._start_frame(filename)
         self.serialhdl.register_stream(0x61, self._note_frame_data)
         self.serialhdl.read_data(time.time() + 0.020)
+        if self.trigger_sync is not None:
+            # Wait for other devices to also be armed
+            self.trigger_sync()
         self.serialhdl.set_bulk_mode(True)
         sys.stdout.write(" START CAPTURE\n")
-        start_time = time.time()
+        self.serialhdl.note_phase("capture_data")
+        start_time = self.trigger_time = time.time()
         if force_trigger:
             self.write_reg("sq", "status", 0x07)
         else:
             self.write_reg("sq", "status", 0x03)
-        for i in range(3000):
+        for i in range(3000 + int(self.frame_time * 100.)):
             self.serialhdl.read_data(start_time + (i + 1) * 0.010)
             sts = self.read_reg("sq", "status")
+            if (self.stream_mode and self.skip_bytes is None
+                and not sts & 0x02):
+                # Trigger position is known - start decoding frame data
+                frame_pos = self.read_reg("sq", "reg_fifo_position")
+                frame_diff = frame_pos - start_pos - frame_prefix - 1
+                self._note_frame_slot(frame_diff & 0xffffffff)
             if sts & 0x0a == 0x00:
                 if sts & 0x01:
                     sys.stdout.write(" CAPTURE COMPLETE\n")
@@ -671,11 +1176,32 @@ class SQHelper:
                 break
         frame_pos = self.read_reg("sq", "reg_fifo_position")
         sys.stdout.write(" FINALIZE CAPTURE\n")
+        self.serialhdl.note_phase("capture_finalize")
         self.serialhdl.set_bulk_mode(False)
         self.write_reg("sq", "status", 0x00)
         frame_diff = frame_pos - start_pos - frame_prefix - 1
-        frame_slot = frame_diff & 0xffffffff
-        self._parse_frame_data(frame_slot)
+        self._finish_frame(frame_diff & 0xffffffff)
+    def _get_segment_filename(self, segment):
+        base, ext = os.path.splitext(self.csvfilename)
+        return "%s_%04d%s" % (base, segment, ext)
+    def capture_frame(self, af_helpers, force_trigger):
+        self._configure_capture(af_helpers)
+        if self.segments == 1 and not self.segment_deadline:
+            self._capture_segment(self.csvfilename, force_trigger)
+            return
+        # Segmented capture - re-arm the sample queue for each frame
+        end_time = None
+        if self.segment_deadline:
+            end_time = time.time() + self.segment_deadline
+        segment = 0
+        while segment < self.segments or not self.segments:
+            if end_time is not None and time.time() >= end_time:
+                break
+            filename = self._get_segment_filename(segment)
+            sys.stdout.write("SEGMENT %d (%s)\n" % (segment, filename))
+            self._capture_segment(filename, force_trigger)
+            segment += 1
+        sys.stdout.write("Captured %d segments\n" % (segment,))
     def setup(self):
         self.write_reg("sq", "status", 0x00)
 
@@ -701,6 +1227,21 @@ PROBES = {
     ('dc10x', '10x'): {'dac': 2.329, 'adc_factor': ADC_GAIN10_FACTOR * 10.},
 }
 
+# Trigger codes (as used in the channel "trigger" register)
+TRIGGER_CODES = {"<": 0x05, ">": 0x07, "_": 0x01, "~": 0x03}
+
+# Parse a trigger description (eg, "<1.0") into (trigger_code, volt)
+def parse_trigger(val):
+    val = val.strip()
+    tcode = TRIGGER_CODES["<"]
+    for s, c in TRIGGER_CODES.items():
+        if val.startswith(s):
+            val = val[1:].strip()
+            tcode = c
+            break
+    tvolt = float(val)
+    return tcode, tvolt
+
 # Haasoscope analog frontend configuration helper
 class AFHelper:
     def __init__(self, serialhdl, dac, ioexp1, channel, interleave_channel):
@@ -767,16 +1308,6 @@ class AFHelper:
         base_adc = info.get('adc', 255. / 2.)
         calib_v = info.get('voltage', 0.)
         self.base_v = calib_v - base_adc * self.adc_factor
-    def _parse_trigger(self, val):
-        val = val.strip()
-        tcode = 0x04
-        for s, c in [("<", 0x04), (">", 0x06), ("_", 0x00), ("~", 0x02)]:
-            if val.startswith(s):
-                val = val[1:].strip()
-                tcode = c
-                break
-        tvolt = float(val)
-        return tcode | 0x01, tvolt
     def note_cmdline_options(self, options):
         channel = self.channel
         if self.interleave:
@@ -790,8 +1321,9 @@ class AFHelper:
         probe_desc = getattr(options, prefix + "probe")
         self._parse_probe_type(probe_desc, mode_desc)
         tdesc = getattr(options, prefix + "trigger")
+        self.trigger_code = 0
         if tdesc is not None:
-            self.trigger_code, self.trigger_volt = self._parse_trigger(tdesc)
+            self.trigger_code, self.trigger_volt = parse_trigger(tdesc)
     def note_switches(self, sw_imp10Mohm, sw_gain100):
         self.sw_imp10Mohm = sw_imp10Mohm
         self.sw_gain100 = sw_gain100
@@ -862,6 +1394,8 @@ class AFHelper:
 FPGA_FREQ=125000000
 FPGA_SLOW_FREQ=62500000
 BAUD=1500000
+SERIAL_TIMEOUT=0.001
+FT232H_CHUNK_SIZE=0x10000
 
 I2C_DAC_ADDR=0x60
 I2C_EXP1_ADDR=0x20
@@ -886,6 +1420,8 @@ PINS_IOEXP2 = {
 class HProcessor:
     def __init__(self):
         self.serialhdl = SerialHandler(fpgaregs.FPGA_MODULES)
+        for modname, regname in fpgaregs.VOLATILE_REGS:
+            self.serialhdl.mark_volatile(modname, regname)
         self.sqhelper = SQHelper(self.serialhdl, FPGA_FREQ)
         self.adcspi = Max19506spi(self.serialhdl)
         self.i2c = i2c = I2CHelper(self.serialhdl)
@@ -917,18 +1453,26 @@ class HProcessor:
             afh.note_cmdline_options(options)
     def note_filename(self, csvfilename):
         self.sqhelper.note_filename(csvfilename)
-    def run(self, ser):
+    def setup_device(self, ser):
+        note_phase = self.serialhdl.note_phase
+        note_phase("connect")
         self.serialhdl.setup(ser)
         self.sqhelper.setup()
+        note_phase("adcspi")
         self.adcspi.setup()
+        note_phase("i2c")
         self.i2c.setup(FPGA_SLOW_FREQ)
-        self.pllphase.setup(self.sqhelper.is_interleaving())
         # configure mcp23017 gpio expander 2
         self.ioexp2.set_output("led0", 1)
         self.ioexp2.update_pins()
         self.ioexp2.read_pins()
         self.ioexp2.dump_pins()
+    def capture(self):
+        note_phase = self.serialhdl.note_phase
+        note_phase("pllphase")
+        self.pllphase.setup(self.sqhelper.is_interleaving())
         # Setup channels
+        note_phase("channels")
         interleave = self.sqhelper.is_interleaving()
         self.ioexp1.set_output("enable_ch2", not interleave)
         self.ioexp1.set_output("enable_ch3", not interleave)
@@ -943,10 +1487,15 @@ class HProcessor:
             if ah.have_trigger():
                 force_trigger = False
         self.ioexp1.update_pins()
+        self.dac.update_dacs()
         self.ioexp1.dump_pins()
         # Capture a frame
         self.sqhelper.capture_frame(self.af_helpers, force_trigger)
+    def run(self, ser):
+        self.setup_device(ser)
+        self.capture()
     def cleanup(self):
+        self.serialhdl.note_phase("cleanup")
         self.serialhdl.clear()
         # Disable ADC
         for ch in range(4):
@@ -956,6 +1505,7 @@ class HProcessor:
         self.ioexp1.update_pins()
         for ch in range(4):
             self.dac.set_dac(ch, 0.0)
+        self.dac.update_dacs()
         # Turn off LEDs
         for led in range(4):
             self.ioexp2.set_output("led%d" % (led,), 0)
@@ -963,28 +1513,126 @@ class HProcessor:
         sys.stdout.write("\nShutdown adc complete.\n")
 
 
+######################################################################
+# Transport profiles
+######################################################################
+
+# Transport settings used when no profile has been saved
+TRANSPORT_DEFAULTS = {
+    "read_size": READ_SIZE, "chunk_size": FT232H_CHUNK_SIZE,
+    "timeout": SERIAL_TIMEOUT,
+}
+
+def get_profile_filename():
+    config_dir = os.environ.get("XDG_CONFIG_HOME")
+    if not config_dir:
+        config_dir = os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(config_dir, "hsoft", "transport.json")
+
+# Profiles are stored per device serial number (or serial port name)
+def get_device_key(options, serialport):
+    if options.sim:
+        return "sim:" + serialport
+    if options.usbhi:
+        return "ft232h:" + serialport
+    return "serial:" + serialport
+
+def format_transport_settings(settings):
+    return " ".join(["%s=%s" % (name, settings[name])
+                     for name in sorted(settings)])
+
+def load_transport_profiles(filename=None):
+    if filename is None:
+        filename = get_profile_filename()
+    try:
+        with io.open(filename, "r") as f:
+            profiles = json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        sys.stdout.write("WARN: Ignoring invalid transport profile file %s\n"
+                         % (filename,))
+        return {}
+    if not isinstance(profiles, dict):
+        return {}
+    return profiles
+
+def load_transport_profile(key, filename=None):
+    # Return the saved transport settings for a device (or None)
+    profile = load_transport_profiles(filename).get(key)
+    if not isinstance(profile, dict):
+        return None
+    try:
+        return {name: type(TRANSPORT_DEFAULTS[name])(profile[name])
+                for name in TRANSPORT_DEFAULTS if name in profile}
+    except (ValueError, TypeError):
+        sys.stdout.write("WARN: Ignoring invalid transport profile for %s\n"
+                         % (key,))
+        return None
+
+def save_transport_profile(key, profile, filename=None):
+    if filename is None:
+        filename = get_profile_filename()
+    profiles = load_transport_profiles(filename)
+    profiles[key] = profile
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpname = filename + ".tmp"
+    with io.open(tmpname, "w") as f:
+        f.write(json.dumps(profiles, indent=1, sort_keys=True))
+    os.rename(tmpname, filename)
+
+def set_transport_settings(options, ser, serialhdl, settings):
+    # Update the settings of an open device
+    serialhdl.set_read_size(settings["read_size"])
+    if isinstance(ser, ThreadedReader):
+        ser.read_size = settings["read_size"]
+        ser = ser.ser
+    if options.sim:
+        return
+    if options.usbhi:
+        ser.read_data_set_chunksize(settings["chunk_size"])
+    else:
+        ser.timeout = settings["timeout"]
+
+
 ######################################################################
 # Startup
 ######################################################################
 
-def setup_serial(serialport):
+def setup_serial(serialport, timeout=SERIAL_TIMEOUT):
     import serial
-    return serial.Serial(serialport, BAUD, timeout=0.001)
+    return serial.Serial(serialport, BAUD, timeout=timeout)
 
-def setup_ft232h(serialport):
+def setup_ft232h(serialport, chunk_size=FT232H_CHUNK_SIZE):
     import pyftdi.ftdi
     Ftdi = pyftdi.ftdi.Ftdi
     ser = Ftdi.create_from_url("ftdi://::%s/%d" % (serialport, 1))
     ser.reset()
     ser.set_bitmode(0xff, Ftdi.BitMode.SYNCFF)
-    ser.read_data_set_chunksize(0x10000)
+    ser.read_data_set_chunksize(chunk_size)
     ser.purge_buffers()
     ser.write = ser.write_data
     ser.read = ser.read_data
     time.sleep(.050)
     return ser
 
-def list_ft232h():
+def setup_sim(settings):
+    import fpgasim
+    # Settings are a comma separated list of "name=value" pairs
+    kwargs = {}
+    for setting in settings.split(','):
+        if setting.strip() in ('', '-'):
+            continue
+        name, val = [s.strip() for s in setting.split('=', 1)]
+        if name != 'rate':
+            raise error("Unknown simulator setting '%s'" % (name,))
+        kwargs['byte_rate'] = float(val)
+    return fpgasim.FPGASim(**kwargs)
+
+def find_ft232h():
+    # Returns (haasoscope_serial_numbers, other_serial_numbers)
     import pyftdi.ftdi
     Ftdi = pyftdi.ftdi.Ftdi
     haas_sn = []
@@ -994,6 +1642,10 @@ def list_ft232h():
             haas_sn.append(dev.sn)
         else:
             other_sn.append(dev.sn)
+    return haas_sn, other_sn
+
+def list_ft232h():
+    haas_sn, other_sn = find_ft232h()
     if not haas_sn and not other_sn:
         print("No hi-speed ft232h devices found.")
         return
@@ -1006,14 +1658,77 @@ def list_ft232h():
         for sn in other_sn:
             print(sn)
 
+def setup_device_options(opts):
+    opts.add_option("-u", "--usbhi", action="store_true",
+                    help="use hi-speed usb module")
+    opts.add_option("--sim", action="store_true",
+                    help="use a simulated fpga (serialdevice is a list of"
+                    " simulator settings, eg 'rate=40000000')")
+    opts.add_option("--threaded", action="store_true",
+                    help="read from the device in a background thread")
+    opts.add_option("--regcache", action="store_true",
+                    help="skip register writes that match the known value")
+    opts.add_option("--trace", type="string", default=None,
+                    help="write request statistics to a json file"
+                    " (or '-' to report histograms)")
+    opts.add_option("--no-profile", action="store_true",
+                    help="do not load the saved transport profile"
+                    " (see hcaptune.py)")
+
+def open_device(options, serialport, hp):
+    settings = dict(TRANSPORT_DEFAULTS)
+    if not options.no_profile:
+        key = get_device_key(options, serialport)
+        profile = load_transport_profile(key)
+        if profile:
+            sys.stdout.write("Using transport profile for %s: %s\n"
+                             % (key, format_transport_settings(profile)))
+            settings.update(profile)
+    if options.sim:
+        ser = setup_sim(serialport)
+    elif options.usbhi:
+        ser = setup_ft232h(serialport, settings["chunk_size"])
+    else:
+        ser = setup_serial(serialport, settings["timeout"])
+    hp.serialhdl.set_read_size(settings["read_size"])
+    if options.threaded:
+        ser = ThreadedReader(ser, settings["read_size"])
+    if options.regcache:
+        hp.serialhdl.set_reg_cache(True)
+    if options.trace is not None:
+        hp.serialhdl.enable_trace()
+    return ser
+
+def close_device(options, ser, hp):
+    if options.threaded:
+        ser.close()
+        sys.stdout.write(ser.get_stats())
+        ser = ser.ser
+    if options.regcache:
+        sys.stdout.write(hp.serialhdl.get_reg_cache_stats())
+    if options.trace is not None:
+        sys.stdout.write(hp.i2c.get_stats())
+    if options.sim:
+        sys.stdout.write(ser.get_stats())
+    if options.trace == '-':
+        sys.stdout.write(hp.serialhdl.get_trace().get_report())
+    elif options.trace is not None:
+        with io.open(options.trace, "w") as f:
+            f.write(json.dumps(hp.serialhdl.get_trace().get_data(),
+                               indent=1, sort_keys=True))
+
 def main():
     # Setup command-line options
     usage = "%prog [options] <serialdevice> <output_csv_file>"
     opts = optparse.OptionParser(usage)
-    opts.add_option("-u", "--usbhi", action="store_true",
-                    help="use hi-speed usb module")
+    setup_device_options(opts)
     opts.add_option("-l", "--listusb", action="store_true",
                     help="list hi-speed usb modules")
+    opts.add_option("--daemon", type="string", default=None,
+                    help="capture using the hcapd daemon at this socket"
+                    " (no serialdevice is specified)")
+    opts.add_option("--convert", action="store_true",
+                    help="convert <raw_file> to <output_file> in --format")
     hp = HProcessor()
     hp.setup_cmdline_options(opts)
 
@@ -1022,6 +1737,18 @@ def main():
     if options.listusb:
         list_ft232h()
         sys.exit(0)
+    if options.convert:
+        if len(args) != 2:
+            opts.error("Must specify raw_file and output_file")
+        capfile.convert_raw(args[0], args[1], options.format, options.jobs)
+        sys.exit(0)
+    if options.daemon is not None:
+        if len(args) != 1:
+            opts.error("Must specify output_csv_file")
+        hp.note_cmdline_options(options, args)
+        import hcapd
+        hcapd.capture_from_daemon(options.daemon, hp, options, args[0])
+        sys.exit(0)
     if len(args) != 2:
         opts.error("Must specify serialdevice and output_csv_file")
     serialport = args[0]
@@ -1030,14 +1757,12 @@ def main():
     hp.note_filename(csvfilename)
 
     # Connect to Haasoscope and capture data
-    if options.usbhi:
-        ser = setup_ft232h(serialport)
-    else:
-        ser = setup_serial(serialport)
+    ser = open_device(options, serialport, hp)
     try:
         hp.run(ser)
     finally:
         hp.cleanup()
+        close_device(options, ser, hp)
 
 if __name__ == '__main__':
     main()
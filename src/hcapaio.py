@@ -0,0 +1,273 @@
+# Asyncio interface to the Haasoscope message protocol
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, time, asyncio, threading
+import hcap, fpgaregs
+
+# Number of queued messages of a coroutine stream callback that pause
+# reading from the device
+STREAM_QUEUE_HIGH = 1024
+
+
+######################################################################
+# Device transport
+######################################################################
+
+# Asyncio transport for a serial device (or simulator).  Devices with a
+# file descriptor are monitored by the event loop, other devices are
+# read from a background thread.
+class SerialTransport(asyncio.Transport):
+    def __init__(self, loop, ser, protocol):
+        asyncio.Transport.__init__(self, {"serial": ser})
+        self.loop = loop
+        self.ser = ser
+        self.protocol = protocol
+        self.fd = None
+        if hasattr(ser, "fileno"):
+            try:
+                self.fd = ser.fileno()
+            except (OSError, ValueError):
+                pass
+        self.is_active = True
+        self.is_paused = False
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.thread = None
+        protocol.connection_made(self)
+        if self.fd is not None:
+            loop.add_reader(self.fd, self._read_ready)
+        else:
+            self.thread = threading.Thread(target=self._reader)
+            self.thread.daemon = True
+            self.thread.start()
+    def _read_ready(self):
+        try:
+            data = os.read(self.fd, hcap.READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fatal_error(e)
+            return
+        if not data:
+            self._fatal_error(hcap.error("Device disconnected"))
+            return
+        self.protocol.data_received(data)
+    def _reader(self):
+        ser_read = self.ser.read
+        loop = self.loop
+        while self.is_active:
+            self.resume_event.wait()
+            try:
+                data = ser_read(hcap.READ_SIZE)
+            except Exception as e:
+                loop.call_soon_threadsafe(self._fatal_error, e)
+                break
+            if data and self.is_active:
+                loop.call_soon_threadsafe(self._data_received, data)
+    def _data_received(self, data):
+        if self.is_active:
+            self.protocol.data_received(data)
+    def _fatal_error(self, exc):
+        if self.is_active:
+            self._stop(exc)
+    def _stop(self, exc):
+        self.is_active = False
+        self.resume_event.set()
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        self.loop.call_soon(self.protocol.connection_lost, exc)
+    def write(self, data):
+        self.ser.write(data)
+    def pause_reading(self):
+        if self.is_paused or not self.is_active:
+            return
+        self.is_paused = True
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        else:
+            self.resume_event.clear()
+    def resume_reading(self):
+        if not self.is_paused or not self.is_active:
+            return
+        self.is_paused = False
+        if self.fd is not None:
+            self.loop.add_reader(self.fd, self._read_ready)
+        else:
+            self.resume_event.set()
+    def is_reading(self):
+        return self.is_active and not self.is_paused
+    def is_closing(self):
+        return not self.is_active
+    def close(self):
+        if not self.is_active:
+            return
+        self._stop(None)
+        if self.thread is not None:
+            self.thread.join()
+
+
+######################################################################
+# Message handling
+######################################################################
+
+# Deliver the messages of a stream to a coroutine function (in order)
+class AsyncStream:
+    def __init__(self, handler, callback):
+        self.handler = handler
+        self.callback = callback
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._process())
+    def note_message(self, msgdata):
+        # Message data is only valid during the call - store a copy
+        self.queue.put_nowait(bytes(msgdata))
+        if self.queue.qsize() >= STREAM_QUEUE_HIGH:
+            self.handler.pause_reading()
+    async def _process(self):
+        while 1:
+            data = await self.queue.get()
+            try:
+                await self.callback(data)
+            finally:
+                self.queue.task_done()
+                if self.queue.empty():
+                    self.handler.resume_reading()
+    async def flush(self):
+        # Wait for all queued messages to be processed
+        join = asyncio.ensure_future(self.queue.join())
+        await asyncio.wait([join, self.task],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if self.task.done():
+            join.cancel()
+            # Report an error raised by the callback
+            self.task.result()
+    def cancel(self):
+        self.task.cancel()
+
+# Message handler using the same framing and request retransmission
+# as hcap.SerialHandler, but driven by an asyncio event loop
+class AsyncSerialHandler(hcap.SerialHandler, asyncio.Protocol):
+    def __init__(self, modregs):
+        hcap.SerialHandler.__init__(self, modregs)
+        self.transport = None
+        self.conn_error = None
+        self.streams = {}
+        self.tx_lock = self.rx_event = None
+    # asyncio.Protocol interface
+    def connection_made(self, transport):
+        self.transport = self.ser = transport
+        self.tx_lock = asyncio.Lock()
+        self.rx_event = asyncio.Event()
+    def data_received(self, data):
+        pos = 0
+        while pos < len(data):
+            # Move any partial message to the start of the buffer
+            if self.rx_start:
+                remaining = self.rx_end - self.rx_start
+                if remaining:
+                    self.rx_buf[:remaining] = self.rx_buf[
+                        self.rx_start:self.rx_end]
+                self.rx_start = 0
+                self.rx_end = remaining
+            count = min(len(data) - pos, hcap.RX_BUFFER_SIZE - self.rx_end)
+            self.rx_buf[self.rx_end:self.rx_end + count] = data[
+                pos:pos + count]
+            self.rx_end += count
+            pos += count
+            self._parse_messages()
+    def connection_lost(self, exc):
+        self.conn_error = exc or hcap.error("Connection closed")
+        self.transport = None
+        if self.rx_event is not None:
+            self.rx_event.set()
+    def pause_reading(self):
+        if self.transport is not None:
+            self.transport.pause_reading()
+    def resume_reading(self):
+        if self.transport is not None:
+            self.transport.resume_reading()
+    # Stream callbacks
+    def register_stream(self, strm_id, callback):
+        # The callback may be a regular function (called with a
+        # memoryview that is only valid during the call) or a coroutine
+        # function (awaited with a bytes copy of each message)
+        stream = self.streams.pop(strm_id, None)
+        if stream is not None:
+            stream.cancel()
+        if callback is not None and asyncio.iscoroutinefunction(callback):
+            stream = self.streams[strm_id] = AsyncStream(self, callback)
+            callback = stream.note_message
+        hcap.SerialHandler.register_stream(self, strm_id, callback)
+    async def flush_streams(self):
+        # Wait for coroutine stream callbacks to process received data
+        for stream in list(self.streams.values()):
+            await stream.flush()
+    # Register requests
+    def _handle_async_response(self, msgdata):
+        self._handle_response(msgdata)
+        if not self.read_finish:
+            self.rx_event.set()
+    async def _wait_responses(self, read_finish):
+        # Wait until a response is processed (or the given time)
+        self.read_finish = read_finish
+        self.rx_event.clear()
+        if self.conn_error is not None:
+            raise hcap.error("Connection lost: %s" % (self.conn_error,))
+        timeout = read_finish - time.time()
+        if timeout > 0.:
+            try:
+                await asyncio.wait_for(self.rx_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    async def _tx_message(self, is_write, addr, val):
+        retry_time = self._begin_cmd(is_write, addr, val)
+        while 1:
+            await self._wait_responses(retry_time)
+            if self.cmd is None:
+                return self.cmd_result
+            retry_time = self._retry_cmd()
+    async def _tx_messages(self, cmds):
+        # Requests of concurrent tasks are not interleaved
+        async with self.tx_lock:
+            try:
+                return [await self._tx_message(*cmd) for cmd in cmds]
+            finally:
+                # Don't block later requests if this task is cancelled
+                self.cmd = None
+    async def access_regs(self, accesses):
+        cmds, sizes = self._build_cmds(accesses)
+        res = await self._tx_messages(cmds)
+        return self._combine_results(res, sizes)
+    async def write_regs(self, writes):
+        await self.access_regs(writes)
+    async def read_regs(self, reads):
+        return await self.access_regs([(modname, regname, None)
+                                       for modname, regname in reads])
+    async def write_reg(self, modname, regname, val):
+        await self.write_regs([(modname, regname, val)])
+    async def read_reg(self, modname, regname):
+        return (await self.read_regs([(modname, regname)]))[0]
+    async def setup(self):
+        hcap.SerialHandler.register_stream(self, 0x60,
+                                           self._handle_async_response)
+        # Verify connection and obtain initial sequence numbers
+        self._flush_connection()
+        self.no_seq_warnings = True
+        vers = await self.read_reg("vers", "code_version")
+        self.no_seq_warnings = False
+        sys.stdout.write("FPGA code version: %d.%d.%d\n"
+                         % (vers >> 16, (vers >> 8) & 0xff, vers & 0xff))
+    def close(self):
+        for stream in self.streams.values():
+            stream.cancel()
+        self.streams.clear()
+        if self.transport is not None:
+            self.transport.close()
+
+# Connect to a device (as returned by hcap.setup_serial() or similar)
+async def open_device(ser, modregs=fpgaregs.FPGA_MODULES):
+    handler = AsyncSerialHandler(modregs)
+    SerialTransport(asyncio.get_running_loop(), ser, handler)
+    await handler.setup()
+    return handler
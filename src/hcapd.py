@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# Haasoscope capture daemon
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, struct, json, time
+import hcap, capfile
+
+DEFAULT_SOCKET = "/tmp/hcapd"
+
+# Maximum time to wait for a client to send its request
+REQUEST_TIMEOUT = 5.
+
+
+######################################################################
+# Message framing
+######################################################################
+
+# Each message is: <type (1 byte)><payload length (4 bytes)><payload>
+MSG_HEADER = struct.Struct("<cI")
+
+MSG_REQUEST = b'R'      # json {"options": {...}, "filename": name}
+MSG_FRAME_START = b'I'  # json {"filename": name, "params": {...}}
+MSG_DATA = b'D'         # raw sample queue data (complete groups)
+MSG_FRAME_END = b'F'    # json {"data_bytes": count}
+MSG_END = b'E'          # json {"status": "ok"} or {"status": "error", ...}
+
+def send_msg(sock, msgtype, payload):
+    sock.sendall(MSG_HEADER.pack(msgtype, len(payload)))
+    sock.sendall(payload)
+
+def send_json(sock, msgtype, data):
+    send_msg(sock, msgtype, json.dumps(data).encode())
+
+def recv_exact(sock, count):
+    buf = bytearray(count)
+    view = memoryview(buf)
+    pos = 0
+    while pos < count:
+        got = sock.recv_into(view[pos:])
+        if not got:
+            raise hcap.error("Connection closed")
+        pos += got
+    return buf
+
+def recv_msg(sock):
+    msgtype, length = MSG_HEADER.unpack(recv_exact(sock, MSG_HEADER.size))
+    return msgtype, recv_exact(sock, length)
+
+# Return an option parser and list of option names for capture settings
+def get_capture_options(hp):
+    opts = optparse.OptionParser()
+    hp.setup_cmdline_options(opts)
+    names = [o.dest for o in opts.option_list if o.dest is not None]
+    return opts, names
+
+
+######################################################################
+# Daemon
+######################################################################
+
+# Output "file" that forwards raw sample queue data to a client
+class SocketWriter:
+    def __init__(self, daemon, filename, info):
+        self.daemon = daemon
+        self.data_bytes = 0
+        daemon.send_json(MSG_FRAME_START, {"filename": filename,
+                                           "params": info.get_params()})
+    def write_data(self, data):
+        self.data_bytes += len(data)
+        self.daemon.send_msg(MSG_DATA, data)
+    def close(self):
+        self.daemon.send_json(MSG_FRAME_END, {"data_bytes": self.data_bytes})
+
+class CaptureDaemon:
+    def __init__(self, hp, sockname):
+        self.hp = hp
+        self.sockname = sockname
+        self.opts, self.option_names = get_capture_options(hp)
+        self.client = None
+        hp.sqhelper.set_writer_class(self._create_writer)
+    def _create_writer(self, filename, info):
+        return SocketWriter(self, filename, info)
+    def send_msg(self, msgtype, payload):
+        # A client that disconnects does not abort an active capture
+        if self.client is None:
+            return
+        try:
+            send_msg(self.client, msgtype, payload)
+        except socket.error as e:
+            sys.stdout.write("Client disconnected: %s\n" % (e,))
+            self.client = None
+    def send_json(self, msgtype, data):
+        self.send_msg(msgtype, json.dumps(data).encode())
+    def _run_capture(self, req):
+        # Build capture options from the defaults and client settings
+        options = self.opts.get_default_values()
+        for name, val in req.get("options", {}).items():
+            if name in self.option_names:
+                setattr(options, name, val)
+        options.stream = True
+        options.envelope = 0
+        try:
+            self.hp.note_cmdline_options(options, [])
+        except (SystemExit, ValueError):
+            raise hcap.error("Invalid capture options")
+        self.hp.note_filename(req.get("filename", "capture.raw"))
+        self.hp.capture()
+    def _handle_client(self, sock):
+        sock.settimeout(REQUEST_TIMEOUT)
+        try:
+            msgtype, payload = recv_msg(sock)
+            if msgtype != MSG_REQUEST:
+                raise hcap.error("Expected request message")
+            req = json.loads(payload.decode())
+        except (socket.error, ValueError, hcap.error) as e:
+            sys.stdout.write("Invalid client request: %s\n" % (e,))
+            return
+        sock.settimeout(None)
+        self.client = sock
+        start_time = time.time()
+        try:
+            self._run_capture(req)
+        except hcap.error as e:
+            sys.stdout.write("Capture failed: %s\n" % (e,))
+            result = {"status": "error", "msg": str(e)}
+        else:
+            result = {"status": "ok", "time": time.time() - start_time}
+        self.send_json(MSG_END, result)
+        self.client = None
+    def serve(self):
+        if os.path.exists(self.sockname):
+            os.remove(self.sockname)
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(self.sockname)
+        srv.listen(8)
+        sys.stdout.write("Listening on %s\n" % (self.sockname,))
+        try:
+            # Captures from multiple clients are run one at a time
+            while 1:
+                sock, addr = srv.accept()
+                try:
+                    self._handle_client(sock)
+                finally:
+                    sock.close()
+        finally:
+            srv.close()
+            os.remove(self.sockname)
+
+
+######################################################################
+# Client
+######################################################################
+
+# Request a capture from a daemon and write the results to a file
+def capture_from_daemon(sockname, hp, options, filename):
+    opts, names = get_capture_options(hp)
+    req = {"options": {name: getattr(options, name) for name in names},
+           "filename": filename}
+    fmt = options.format
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sockname)
+    writer = None
+    try:
+        send_json(sock, MSG_REQUEST, req)
+        while 1:
+            msgtype, payload = recv_msg(sock)
+            if msgtype == MSG_DATA:
+                writer.write_data(payload)
+            elif msgtype == MSG_FRAME_START:
+                msg = json.loads(payload.decode())
+                info = capfile.CaptureInfo(msg["params"])
+                writer = capfile.FORMATS[fmt](msg["filename"], info)
+                sys.stdout.write("Capturing to %s\n" % (msg["filename"],))
+            elif msgtype == MSG_FRAME_END:
+                writer.close()
+                writer = None
+            elif msgtype == MSG_END:
+                result = json.loads(payload.decode())
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+        sock.close()
+    if result["status"] != "ok":
+        raise hcap.error("Capture failed: %s" % (result.get("msg"),))
+    sys.stdout.write("Capture complete (%.3fs)\n" % (result["time"],))
+
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <serialdevice>"
+    opts = optparse.OptionParser(usage)
+    hcap.setup_device_options(opts)
+    opts.add_option("-s", "--socket", type="string", default=DEFAULT_SOCKET,
+                    help="unix domain socket to listen on")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Must specify serialdevice")
+    hp = hcap.HProcessor()
+    ser = hcap.open_device(options, args[0], hp)
+    try:
+        hp.setup_device(ser)
+        daemon = CaptureDaemon(hp, options.socket)
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hp.cleanup()
+        hcap.close_device(options, ser, hp)
+
+if __name__ == '__main__':
+    main()
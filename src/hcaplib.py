@@ -0,0 +1,98 @@
+# Python interface for capturing data from a Haasoscope
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse
+import hcap, capfile
+
+# Return the list of option names in an option parser
+def get_option_names(opts):
+    return [o.dest for o in opts.option_list if o.dest is not None]
+
+# Build an options object from the defaults and a dict of settings.
+# Settings use the command-line option names (eg, "queryrate") and
+# values (eg, "25Mhz").
+def build_options(opts, settings):
+    options = opts.get_default_values()
+    for name, val in settings.items():
+        opt = [o for o in opts.option_list if o.dest == name]
+        if not opt:
+            raise hcap.error("Unknown setting '%s'" % (name,))
+        if opt[0].type == "string" and val is not None:
+            val = str(val)
+        setattr(options, name, val)
+    return options
+
+def get_device_parser():
+    opts = optparse.OptionParser()
+    hcap.setup_device_options(opts)
+    return opts
+
+
+######################################################################
+# Capture session
+######################################################################
+
+# An open connection to a Haasoscope that can run multiple captures
+class CaptureSession:
+    def __init__(self, serialport, **device_settings):
+        self.options = build_options(get_device_parser(), device_settings)
+        self.hp = hp = hcap.HProcessor()
+        self.capture_opts = optparse.OptionParser()
+        hp.setup_cmdline_options(self.capture_opts)
+        self.writers = []
+        hp.sqhelper.set_writer_class(self._create_writer)
+        self.ser = hcap.open_device(self.options, serialport, hp)
+        try:
+            hp.setup_device(self.ser)
+        except:
+            self.close()
+            raise
+    def _create_writer(self, filename, info):
+        writer = capfile.CaptureWriter(info)
+        self.writers.append(writer)
+        return writer
+    def capture_segments(self, **settings):
+        # Returns a list of Capture objects (one per segment)
+        options = build_options(self.capture_opts, settings)
+        # Data is decoded as it arrives
+        options.stream = True
+        options.envelope = 0
+        try:
+            self.hp.note_cmdline_options(options, [])
+        except (SystemExit, ValueError):
+            raise hcap.error("Invalid capture settings")
+        self.hp.note_filename("capture")
+        self.writers = []
+        self.hp.capture()
+        return [w.get_capture() for w in self.writers
+                if w.get_capture() is not None]
+    def capture(self, **settings):
+        if "segments" in settings or "segment_deadline" in settings:
+            raise hcap.error("Use capture_segments() for segmented captures")
+        captures = self.capture_segments(**settings)
+        if len(captures) != 1:
+            raise hcap.error("Capture failed")
+        return captures[0]
+    def close(self):
+        if self.hp is None:
+            return
+        try:
+            self.hp.cleanup()
+        finally:
+            hcap.close_device(self.options, self.ser, self.hp)
+            self.hp = None
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+# Connect to a Haasoscope, capture a frame, and disconnect.  Settings
+# may contain both device options (eg, "sim") and capture settings.
+def capture(serialport, **settings):
+    device_names = get_option_names(get_device_parser())
+    device_settings = {name: settings.pop(name) for name in list(settings)
+                       if name in device_names}
+    with CaptureSession(serialport, **device_settings) as session:
+        return session.capture(**settings)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# Capture from several Haasoscopes at the same time
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, io, copy, optparse, threading, time
+import numpy
+import hcap, capfile
+
+# Maximum time to wait for all devices to be configured and armed
+ARM_TIMEOUT = 60.
+
+# Number of samples of each device to merge at a time
+MERGE_BLOCK_SAMPLES = 65536
+
+MERGE_FORMATS = ["csv", "npy"]
+
+
+######################################################################
+# Merging of per-device captures
+######################################################################
+
+def get_board_filename(filename, board):
+    return "%s_board%d.raw" % (os.path.splitext(filename)[0], board)
+
+# Access to the raw captures of several devices aligned on their trigger
+class MergedCapture:
+    def __init__(self, rawfilenames):
+        self.readers = [capfile.RawReader(fn) for fn in rawfilenames]
+        infos = [r.get_info() for r in self.readers]
+        self.sample_time = infos[0].get_sample_time()
+        for info in infos[1:]:
+            if info.get_sample_time() != self.sample_time:
+                raise hcap.error("Captures have different sample rates")
+        # Start each capture so that the trigger samples line up
+        triggers = [r.get_trigger_sample() for r in self.readers]
+        self.offsets = [t - min(triggers) for t in triggers]
+        self.num_samples = max(0, min([r.get_num_samples() - offset
+                                       for r, offset in zip(self.readers,
+                                                            self.offsets)]))
+        # Merged channel numbers (4 per device)
+        self.channels = []
+        for board, info in enumerate(infos):
+            decoder = info.get_decoder()
+            self.channels.extend([board * 4 + ch
+                                  for ch in decoder.get_report_channels()])
+    def get_readers(self):
+        return self.readers
+    def get_offsets(self):
+        return self.offsets
+    def get_channels(self):
+        return self.channels
+    def get_sample_time(self):
+        return self.sample_time
+    def get_num_samples(self):
+        return self.num_samples
+    def get_header_lines(self):
+        hdrs = ["; HSoft multiple device capture"]
+        for board, reader in enumerate(self.readers):
+            hdrs.append(";")
+            hdrs.append("; board%d: trigger_sample=%d merge_offset=%d"
+                        % (board, reader.get_trigger_sample(),
+                           self.offsets[board]))
+            hdrs.extend(reader.get_info().get_header_lines())
+        return hdrs
+    def read_samples(self, start, count):
+        # Return a (samples, channels) array of voltages
+        count = max(0, min(count, self.num_samples - start))
+        return numpy.hstack([r.read_samples(start + offset, count)
+                             for r, offset in zip(self.readers,
+                                                  self.offsets)])
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+# Merged comma separated values (text) output
+class MergedCSVWriter:
+    def __init__(self, filename, mcap):
+        self.mcap = mcap
+        readers = mcap.get_readers()
+        self.encoders = [capfile.CSVEncoder(r.get_info()) for r in readers]
+        # Combine the volt text tables of all devices
+        width = max([e.volt_text.shape[1] for e in self.encoders])
+        tables = []
+        self.columns = []
+        base = 0
+        for reader, encoder in zip(readers, self.encoders):
+            table = encoder.volt_text
+            tables.append(numpy.pad(table, ((0, 0),
+                                            (0, width - table.shape[1]))))
+            self.columns.append((base, reader.get_info().get_decoder()
+                                 .get_report_channels()))
+            base += len(table)
+        self.volt_text = numpy.concatenate(tables)
+        self.line_end = numpy.frombuffer(b"\n", numpy.uint8)
+        hdrs = mcap.get_header_lines()
+        hdrs.append("time,%s" % (",".join(["ch%d" % (ch,)
+                                           for ch in mcap.get_channels()]),))
+        hdrs.append("")
+        self.csvf = io.open(filename, "wb")
+        self.csvf.write("\n".join(hdrs).encode())
+        self.line_num = 0
+    def write_samples(self, start, count):
+        mcap = self.mcap
+        readers = mcap.get_readers()
+        idx = []
+        for reader, encoder, offset, (base, report_channels) in zip(
+                readers, self.encoders, mcap.get_offsets(), self.columns):
+            pos, data = reader.read_sample_data(start + offset, count)
+            board_idx = encoder.get_text_index(data)[pos:pos + count]
+            idx.append(board_idx[:, report_channels] + base)
+        idx = numpy.hstack(idx)
+        times = self.encoders[0].encode_times(start, len(idx))
+        self.csvf.write(capfile.build_csv_lines(times, self.volt_text, idx,
+                                                self.line_end))
+        self.line_num += len(idx)
+    def close(self):
+        self.csvf.write(b"; End of capture (%d data lines)\n"
+                        % (self.line_num,))
+        self.csvf.close()
+
+# Merged per-channel numpy arrays
+class MergedNPYWriter:
+    def __init__(self, filename, mcap):
+        self.mcap = mcap
+        filename = os.path.splitext(filename)[0]
+        channels = mcap.get_channels()
+        self.npy_files = [capfile.NPYArrayFile("%s_ch%d.npy" % (filename, ch),
+                                               "<f4") for ch in channels]
+        hdrs = mcap.get_header_lines()
+        hdrs.append("; sample_time=%.12f" % (mcap.get_sample_time(),))
+        for ch in channels:
+            hdrs.append("; ch%d=%s_ch%d.npy" % (ch, filename, ch))
+        hdrs.append("")
+        infof = io.open(filename + "_info.txt", "w")
+        infof.write("\n".join(hdrs))
+        infof.close()
+    def write_samples(self, start, count):
+        volts = self.mcap.read_samples(start, count)
+        for i, npyf in enumerate(self.npy_files):
+            npyf.write(volts[:, i])
+    def close(self):
+        for npyf in self.npy_files:
+            npyf.close()
+
+MERGE_WRITERS = {"csv": MergedCSVWriter, "npy": MergedNPYWriter}
+
+# Write the trigger aligned data of several raw captures to a single file
+def merge_raw(rawfilenames, outfilename, fmt="csv"):
+    mcap = MergedCapture(rawfilenames)
+    writer = MERGE_WRITERS[fmt](outfilename, mcap)
+    num_samples = mcap.get_num_samples()
+    for start in range(0, num_samples, MERGE_BLOCK_SAMPLES):
+        writer.write_samples(start, min(MERGE_BLOCK_SAMPLES,
+                                        num_samples - start))
+    writer.close()
+    mcap.close()
+    return num_samples, mcap.get_channels()
+
+
+######################################################################
+# Capture from multiple devices
+######################################################################
+
+# A device (and its capture thread)
+class BoardCapture:
+    def __init__(self, board, serialport, options, filename):
+        self.board = board
+        self.serialport = serialport
+        self.filename = filename
+        self.options = options = copy.copy(options)
+        if options.trace not in (None, '-'):
+            base, ext = os.path.splitext(options.trace)
+            options.trace = "%s_board%d%s" % (base, board, ext)
+        self.hp = hcap.HProcessor()
+        self.ser = None
+        self.thread = None
+        self.error = None
+        self.end_time = 0.
+    def open(self):
+        sys.stdout.write("Board %d: %s\n" % (self.board, self.serialport))
+        self.ser = hcap.open_device(self.options, self.serialport, self.hp)
+    def start(self, args, barrier):
+        hp = self.hp
+        hp.note_cmdline_options(self.options, args)
+        hp.note_filename(self.filename)
+        hp.sqhelper.set_trigger_sync(lambda: barrier.wait(ARM_TIMEOUT))
+        self.thread = threading.Thread(target=self._run, args=(barrier,))
+        self.thread.start()
+    def _run(self, barrier):
+        try:
+            self.hp.run(self.ser)
+        except Exception as e:
+            self.error = e
+            # Don't leave the other devices waiting for this one
+            barrier.abort()
+        self.end_time = time.time()
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+    def get_error(self):
+        return self.error
+    def get_trigger_time(self):
+        return self.hp.sqhelper.get_trigger_time()
+    def get_end_time(self):
+        return self.end_time
+    def get_bytes(self):
+        return self.hp.sqhelper.frame_bytes
+    def close(self):
+        if self.ser is None:
+            return
+        try:
+            self.hp.cleanup()
+        finally:
+            hcap.close_device(self.options, self.ser, self.hp)
+            self.ser = None
+
+def report_throughput(boards):
+    trigger_times = [b.get_trigger_time() for b in boards]
+    start_time = min(trigger_times)
+    total_bytes = 0
+    for b in boards:
+        duration = max(.000001, b.get_end_time() - b.get_trigger_time())
+        sys.stdout.write("Board %d: %d bytes in %.3fs (%.3f MBytes/s)\n"
+                         % (b.board, b.get_bytes(), duration,
+                            b.get_bytes() / duration / 1000000.))
+        total_bytes += b.get_bytes()
+    duration = max(.000001, max([b.get_end_time() for b in boards])
+                   - start_time)
+    sys.stdout.write("Trigger skew between devices: %.6fs\n"
+                     % (max(trigger_times) - start_time,))
+    sys.stdout.write("Aggregate throughput: %d bytes in %.3fs"
+                     " (%.3f MBytes/s)\n"
+                     % (total_bytes, duration,
+                        total_bytes / duration / 1000000.))
+
+def capture_multi(serialports, options, args, filename):
+    # Each device is read by its own reader thread and stores its data
+    # in its own raw file
+    options = copy.copy(options)
+    options.threaded = True
+    options.format = "raw"
+    options.envelope = 0
+    boards = [BoardCapture(board, serialport, options,
+                           get_board_filename(filename, board))
+              for board, serialport in enumerate(serialports)]
+    # All devices enable their trigger once every device is armed
+    barrier = threading.Barrier(len(boards))
+    try:
+        for b in boards:
+            b.open()
+        for b in boards:
+            b.start(args, barrier)
+        for b in boards:
+            b.wait()
+    finally:
+        for b in boards:
+            b.wait()
+            b.close()
+    errors = [b.get_error() for b in boards if b.get_error() is not None]
+    if errors:
+        # Report the original failure (not a broken trigger barrier)
+        errors.sort(key=lambda e: isinstance(e, threading.BrokenBarrierError))
+        raise errors[0]
+    report_throughput(boards)
+    return [b.filename for b in boards]
+
+def main():
+    usage = "%prog [options] <output_file> [<serialdevice> ...]"
+    opts = optparse.OptionParser(usage)
+    hcap.setup_device_options(opts)
+    opts.add_option("--merge", action="store_true",
+                    help="merge existing raw files (listed instead of"
+                    " serial devices) into <output_file>")
+    hp = hcap.HProcessor()
+    hp.setup_cmdline_options(opts)
+    options, args = opts.parse_args()
+    if not args:
+        opts.error("Must specify output_file")
+    if options.format not in MERGE_FORMATS:
+        opts.error("Merged output must use format %s"
+                   % (" or ".join(MERGE_FORMATS),))
+    filename = args[0]
+    if options.merge:
+        rawfilenames = args[1:]
+        if not rawfilenames:
+            opts.error("Must specify raw files to merge")
+    else:
+        serialports = args[1:]
+        if not serialports and options.usbhi:
+            serialports = hcap.find_ft232h()[0]
+        if not serialports:
+            opts.error("Must specify serial devices (or --usbhi to use"
+                       " all hi-speed Haasoscopes)")
+        if options.segments != 1 or options.segment_deadline is not None:
+            opts.error("Segmented captures are not supported")
+        # Check the capture options before starting any device threads
+        hp.note_cmdline_options(options, args)
+        rawfilenames = capture_multi(serialports, options, args, filename)
+    num_samples, channels = merge_raw(rawfilenames, filename, options.format)
+    sys.stdout.write("Wrote %d samples of %d channels to %s\n"
+                     % (num_samples, len(channels), filename))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Tune the host transport settings used to read from a Haasoscope
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, io, optparse, time, contextlib
+import hcap, hcaplib
+
+# Candidate transport settings
+READ_SIZES = [4096, 16384, 65536, 262144]
+FT232H_CHUNK_SIZES = [0x1000, 0x4000, 0x10000, 0x40000]
+SERIAL_TIMEOUTS = [0.0005, 0.001, 0.005, 0.020]
+
+# Sample rate dividers of the test streams (fastest stream first)
+STREAM_DIVS = [1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 20, 25, 32, 40, 50, 64,
+               80, 100, 128, 160, 200, 256]
+
+# Fraction of the frame data that must arrive for a sustained stream
+SUSTAINED_FRACTION = 0.99
+
+def get_candidates(options):
+    # Return a list of settings to test
+    extra = [{}]
+    if options.usbhi:
+        extra = [{"chunk_size": cs} for cs in FT232H_CHUNK_SIZES]
+    elif not options.sim:
+        extra = [{"timeout": t} for t in SERIAL_TIMEOUTS]
+    candidates = []
+    for read_size in READ_SIZES:
+        for e in extra:
+            settings = dict(hcap.TRANSPORT_DEFAULTS)
+            settings["read_size"] = read_size
+            settings.update(e)
+            candidates.append(settings)
+    return candidates
+
+
+######################################################################
+# Throughput measurement
+######################################################################
+
+# Output "file" that discards the capture data
+class NullWriter:
+    def __init__(self, filename, info):
+        pass
+    def write_data(self, data):
+        pass
+    def close(self):
+        pass
+
+class TransportTuner:
+    def __init__(self, options, ser, hp, duration):
+        self.options = options
+        self.ser = ser
+        self.hp = hp
+        self.duration = duration
+        self.capture_opts = optparse.OptionParser()
+        hp.setup_cmdline_options(self.capture_opts)
+        hp.sqhelper.set_writer_class(NullWriter)
+        hp.sqhelper.set_trigger_sync(self._note_trigger)
+        self.trigger_cpu = 0.
+        # Index of the fastest stream sustained by any settings
+        self.best_idx = None
+    def _note_trigger(self):
+        self.trigger_cpu = time.process_time()
+    def _run_stream(self, idx):
+        # Capture a known stream of SAMPLE messages (all four channels
+        # with 8 bit measurements at a given sample rate)
+        hp = self.hp
+        sqhelper = hp.sqhelper
+        div = STREAM_DIVS[idx]
+        # Round down so that the rate parses to exactly this divider
+        qrate = int(sqhelper.fpga_freq * 1000. / div) / 1000.
+        settings = {"queryrate": "%.3fhz" % (qrate,), "bits": 8,
+                    "duration": "%.6fs" % (self.duration,), "stream": True,
+                    "channels": "ch0,ch1,ch2,ch3"}
+        options = hcaplib.build_options(self.capture_opts, settings)
+        hp.note_cmdline_options(options, [])
+        hp.note_filename("tune")
+        with contextlib.redirect_stdout(io.StringIO()):
+            hp.capture()
+        end_time = time.time()
+        cpu = time.process_time() - self.trigger_cpu
+        elapsed = max(.000001, end_time - sqhelper.get_trigger_time())
+        data_bytes = sqhelper.frame_bytes
+        expected = sqhelper.expected_bytes
+        return {
+            "stream_rate": expected / (sqhelper.frame_time
+                                       + sqhelper.preface_time),
+            "sustained": data_bytes >= expected * SUSTAINED_FRACTION,
+            "throughput": data_bytes / elapsed,
+            "cpu_per_mb": cpu / max(1, data_bytes) * 1000000.,
+        }
+    def measure(self, settings):
+        # Find the fastest stream that the settings can sustain
+        hcap.set_transport_settings(self.options, self.ser,
+                                    self.hp.serialhdl, settings)
+        if self.best_idx is None:
+            idx = 0
+            res = self._run_stream(idx)
+            while not res["sustained"] and idx < len(STREAM_DIVS) - 1:
+                idx += 1
+                res = self._run_stream(idx)
+        else:
+            idx = self.best_idx
+            res = self._run_stream(idx)
+            while res["sustained"] and idx > 0:
+                faster = self._run_stream(idx - 1)
+                if not faster["sustained"]:
+                    break
+                idx -= 1
+                res = faster
+        if res["sustained"] and (self.best_idx is None
+                                 or idx <= self.best_idx):
+            self.best_idx = idx
+        return res
+
+def rank_result(res):
+    # Prefer the fastest sustained stream (with the lowest cpu cost),
+    # otherwise the highest throughput
+    if res["sustained"]:
+        return (1, res["stream_rate"], -res["cpu_per_mb"])
+    return (0, res["throughput"], -res["cpu_per_mb"])
+
+def format_result(res):
+    desc = "stream=%.3fMB/s" % (res["stream_rate"] / 1000000.,)
+    if not res["sustained"]:
+        desc += "(overflow)"
+    return "%s throughput=%.3fMB/s cpu=%.1fms/MB" % (
+        desc, res["throughput"] / 1000000., res["cpu_per_mb"] * 1000.)
+
+def tune(options, ser, hp, duration):
+    tuner = TransportTuner(options, ser, hp, duration)
+    results = []
+    for settings in get_candidates(options):
+        res = tuner.measure(settings)
+        results.append((settings, res))
+        sys.stdout.write("%s: %s\n"
+                         % (hcap.format_transport_settings(settings),
+                            format_result(res)))
+        sys.stdout.flush()
+    return max(results, key=lambda r: rank_result(r[1]))
+
+def main():
+    usage = "%prog [options] <serialdevice>"
+    opts = optparse.OptionParser(usage)
+    hcap.setup_device_options(opts)
+    opts.add_option("--duration", type="float", default=0.5,
+                    help="duration (in seconds) of each test stream")
+    opts.add_option("--no-save", action="store_true",
+                    help="report the best settings without saving them")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Must specify serialdevice")
+    serialport = args[0]
+    key = hcap.get_device_key(options, serialport)
+    # Measure starting from the default settings
+    options.no_profile = True
+    hp = hcap.HProcessor()
+    ser = hcap.open_device(options, serialport, hp)
+    try:
+        hp.setup_device(ser)
+        settings, res = tune(options, ser, hp, max(.010, options.duration))
+    finally:
+        hp.cleanup()
+        hcap.close_device(options, ser, hp)
+    sys.stdout.write("Best settings for %s: %s\n  %s\n"
+                     % (key, hcap.format_transport_settings(settings),
+                        format_result(res)))
+    if options.no_save:
+        return
+    profile = dict(settings)
+    profile.update({"throughput": res["throughput"],
+                    "cpu_per_mb": res["cpu_per_mb"],
+                    "tune_time": time.asctime()})
+    hcap.save_transport_profile(key, profile)
+    sys.stdout.write("Saved transport profile to %s\n"
+                     % (hcap.get_profile_filename(),))
+
+if __name__ == '__main__':
+    main()
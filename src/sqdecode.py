@@ -0,0 +1,69 @@
+# Decoding of Haasoscope sample queue data
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import numpy
+
+# Each sample queue entry is 72 bits
+BYTES_PER_SAMPLE = 9
+
+# Mapping of bit resolution to fpga control code
+DEPOSIT_TYPES = {
+    # num_bits: (measurements_per_sample, shift, code)
+    8: (9, 8, 0), 12: (6, 12, 1), 6: (12, 6, 2),
+}
+
+# Batched decoding of sample queue entries into per-channel arrays
+class SampleDecoder:
+    def __init__(self, meas_bits, meas_mask, channels, interleave=False):
+        # The 'channels' parameter is a list of (ch, base_v, adc_factor)
+        # for each channel reported in the sample queue data
+        self.meas_per_sample, meas_shift, code = DEPOSIT_TYPES[meas_bits]
+        self.meas_mask = meas_mask
+        self.interleave = interleave
+        self.channels = [ch for ch, base_v, adc_factor in channels]
+        self.base_v = numpy.array([bv for ch, bv, af in channels])
+        self.adc_factor = numpy.array([af for ch, bv, af in channels])
+        self.num_channels = len(channels)
+        # Build map of byte offsets for each measurement in an entry
+        self.cmap = []
+        for j in range(self.meas_per_sample):
+            mnum = self.meas_per_sample - 1 - j
+            shift = (j * meas_shift) % 8
+            byte_start = (j * meas_shift) // 8
+            offsets = [(byte_start + k) % BYTES_PER_SAMPLE for k in range(3)]
+            self.cmap.append((mnum, offsets, shift))
+    def get_group_size(self):
+        return BYTES_PER_SAMPLE * self.num_channels
+    def get_meas_per_sample(self):
+        return self.meas_per_sample
+    def get_report_channels(self):
+        # In interleave mode ch2 and ch3 provide the odd samples of ch0/ch1
+        if self.interleave:
+            return [ch for ch in self.channels if ch < 2]
+        return list(self.channels)
+    def decode_codes(self, data):
+        # Extract raw measurements - 'data' must contain complete groups
+        nc = self.num_channels
+        raw = numpy.frombuffer(data, numpy.uint8).reshape(
+            -1, nc, BYTES_PER_SAMPLE).astype(numpy.uint32)
+        codes = numpy.empty((raw.shape[0], self.meas_per_sample, nc),
+                            numpy.uint32)
+        for mnum, (off0, off1, off2), shift in self.cmap:
+            d = (raw[:, :, off0] | (raw[:, :, off1] << 8)
+                 | (raw[:, :, off2] << 16))
+            codes[:, mnum, :] = (d >> shift) & self.meas_mask
+        return codes.reshape(-1, nc)
+    def codes_to_volts(self, codes):
+        # Convert codes to a (lines, 4) array of voltages
+        volts = numpy.zeros((codes.shape[0], 4))
+        volts[:, self.channels] = self.base_v + codes * self.adc_factor
+        return volts
+    def decode(self, data):
+        return self.codes_to_volts(self.decode_codes(data))
+    def report_volts(self, volts):
+        # Convert a (lines, 4) array to a (samples, report_channels) array
+        if self.interleave:
+            volts = volts.reshape(-1, 2)
+        return volts[:, self.get_report_channels()]
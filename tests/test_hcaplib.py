@@ -0,0 +1,30 @@
+# Tests of the capture session interface (using the fpga simulator)
+#
+# Copyright (C) 2023  Kevin O'Connor <kevin@koconnor.net>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, io, unittest, contextlib
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import hcaplib
+
+class CaptureSessionTests(unittest.TestCase):
+    def test_consecutive_captures(self):
+        # Settings of one capture must not leak into the next capture
+        with contextlib.redirect_stdout(io.StringIO()):
+            session = hcaplib.CaptureSession("-", sim=True, no_profile=True)
+        with session:
+            seg_out = io.StringIO()
+            with contextlib.redirect_stdout(seg_out):
+                captures = session.capture_segments(
+                    queryrate="25Mhz", duration="100us",
+                    segment_deadline="20ms")
+            self.assertGreaterEqual(len(captures), 1)
+            self.assertIn("SEGMENT 0", seg_out.getvalue())
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                cap = session.capture(queryrate="25Mhz", duration="100us")
+            self.assertNotIn("SEGMENT", out.getvalue())
+            self.assertGreater(cap.get_num_samples(), 0)
+
+if __name__ == '__main__':
+    unittest.main()